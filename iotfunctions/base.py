@@ -17,6 +17,7 @@ import os
 import urllib3
 import numbers
 import datetime as dt
+import functools
 import logging
 import warnings
 import json
@@ -32,11 +33,12 @@ import ibm_db_dbi
 from sqlalchemy.orm.session import sessionmaker
 from inspect import getargspec
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from .db import Database, SystemLogTable
 from .metadata import EntityType, Model
 from .automation import TimeSeriesGenerator
 from .pipeline import CalcPipeline, PipelineExpression
-from .util import log_df_info
+from .util import log_df_info, timed_service_call
 from .ui import UIFunctionOutSingle, UIMultiItem, UISingle
 
 logger = logging.getLogger(__name__)
@@ -78,6 +80,16 @@ class BaseFunction(object):
     itemTags = None #dict: Tags to be added to data items
     # processing settings
     execute_by = None #if function should be executed separately for each entity or some other key, capture this key here
+    is_cross_entity = False #function needs data for all entities in a single dataframe. Not executed in entity partitions
+    returns_column_delta = False #execute returns a dataframe containing only new columns. The pipeline attaches them to its dataframe
+    _is_pipeline_stage = False #set by the pipeline. Stages of a pipeline add columns to the pipeline dataframe without copying it
+    requires_all_source_items = False #function uses source columns that it does not declare as inputs. Disables projection of source data
+    has_side_effects = True #set False when execute only adds columns to the dataframe. Stages with side effects are not executed concurrently with other stages
+    is_cacheable = False #set True when outputs depend only on arguments, constants and input items. Outputs may then be loaded from the stage result cache
+    is_row_wise = False #execute adds columns using vectorized row-wise operations only. Consecutive row-wise stages are fused
+    requires_index_columns = None #execute reads the entity id or timestamp as columns rather than index levels. None infers this from the declared inputs and assumes True when there are none
+    _prefetched_data = None #data retrieved by the pipeline before the stage executes
+    _prefetched_scope = None #start_ts, end_ts and entities of the execution that the data was retrieved for
     test_rows = 100 #rows of data to use when testing function
     base_initialized = True # use to test that object was initialized from BaseFunction
     merge_strategy = 'transform_only' #use to describe how this function's outputs are merged with outputs of the previous stage
@@ -260,13 +272,17 @@ class BaseFunction(object):
             except KeyError as e:
                 msg = 'Attempting to conform index. Cannot find a timestamp column. Looking for %s ' %tss
                 raise KeyError(msg)
-            df[self._entity_type._df_index_entity_id] = id_series.astype(str)
+            if self.get_entity_type_param('_encode_entity_ids'):
+                df[self._entity_type._df_index_entity_id] = self._entity_type.encode_entity_ids(id_series)
+            else:
+                df[self._entity_type._df_index_entity_id] = id_series.astype(str)
             df[self._entity_type._timestamp] = pd.to_datetime(timestamp_series)
             df = df.set_index([self._entity_type._df_index_entity_id,self._entity_type._timestamp])
             msg = 'Dataframe had non-conforming index. Built new index on id and timestamp'
             logger.debug(msg)
-        df[self._entity_type._timestamp_col] = df.index.get_level_values(self._entity_type._timestamp)
-        df[self._entity_type._entity_id] = df.index.get_level_values(self._entity_type._df_index_entity_id)
+        if self.get_entity_type_param('_index_columns'):
+            df[self._entity_type._timestamp_col] = df.index.get_level_values(self._entity_type._timestamp)
+            df[self._entity_type._entity_id] = df.index.get_level_values(self._entity_type._df_index_entity_id)
         self.log_df_info(df,'after  conform index')
         
         return df
@@ -301,7 +317,7 @@ class BaseFunction(object):
                     group_base.append(pd.Grouper(axis=0, level=df.index.names.index(s)))
                     
         if len(group_base)>0:
-            df = df.groupby(group_base).apply(self._calc)                
+            df = df.groupby(group_base,observed=True).apply(self._calc)                
         else:
             df = self._calc(df)
             
@@ -498,6 +514,15 @@ class BaseFunction(object):
         are explicly referenced in function inputs are included.
         '''
         return(set())
+
+    def get_source_items(self):
+        '''
+        Implement this method to return a set of columns of the entity type
+        source table that are needed in addition to the input items, e.g. keys
+        used by a custom data source or lookup. Only these columns and input items
+        are retrieved from the source table.
+        '''
+        return(set())
     
     def get_item_values(self,arg):
         """
@@ -802,6 +827,39 @@ class BaseFunction(object):
         return bucket    
     
     
+    def get_prefetch_task(self,df):
+        '''
+        Return a function with no arguments that retrieves the data needed by
+        the stage. The pipeline executes these functions concurrently before the
+        stages execute. Retrieve the result using pop_prefetched_data().
+        Return None when the stage does not retrieve data.
+        '''
+        return None
+    
+    def pop_prefetched_data(self):
+        '''
+        Return the data retrieved for this stage by the pipeline, or None
+        '''
+        data = self._prefetched_data
+        self._prefetched_data = None
+        return data
+    
+    def fetch_concurrently(self,tasks):
+        '''
+        Execute a list of functions with no arguments on a thread pool.
+        Returns a list of results in the order of the tasks.
+        '''
+        try:
+            workers = self._entity_type.get_param('_max_fetch_workers')
+        except AttributeError:
+            workers = None
+        if len(tasks) < 2:
+            return [t() for t in tasks]
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(t) for t in tasks]
+            return [f.result() for f in futures]
+    
+    @timed_service_call('db')
     def get_scd_data(self,table_name,start_ts, end_ts, entities):
         '''
         Retrieve a slowly changing dimension property as a dataframe
@@ -906,8 +964,9 @@ class BaseFunction(object):
         if len(scd_metadata) ==0:
             return None
         else:
-            for (scd_property, table) in scd_metadata:
-                df = self.get_scd_data(table_name=table, start_ts=start_ts, end_ts = end_ts, entities = entities)
+            tasks = [functools.partial(self.get_scd_data,table_name=table, start_ts=start_ts, end_ts = end_ts, entities = entities)
+                     for (scd_property, table) in scd_metadata]
+            for ((scd_property, table),df) in zip(scd_metadata,self.fetch_concurrently(tasks)):
                 x[scd_property] = self._partition_df_by_id(df)
             return x
         
@@ -938,6 +997,15 @@ class BaseFunction(object):
             
         
 
+    def copy_df(self,df):
+        '''
+        Get a dataframe that the function can add columns to. A pipeline owns the
+        dataframe that it passes to its stages, so stages of a pipeline do not copy it.
+        '''
+        if self._is_pipeline_stage:
+            return df
+        return df.copy()
+
     def _inferOutputs(self,before_df,after_df):
         '''
         Work out which columns were added to the test dataframe by executing the function. These are the outputs.
@@ -1031,7 +1099,7 @@ class BaseFunction(object):
         '''
         Partition dataframe into a dictionary keyed by _entity_id
         '''
-        d = {x: table for x, table in df.groupby(self._entity_type._entity_id)}
+        d = {x: table for x, table in df.groupby(self.get_entity_id_series(df),observed=True)}
         return d    
     
     @classmethod
@@ -1356,6 +1424,7 @@ class BaseDataSource(BaseTransformer):
 
     """
     is_data_source = True
+    requires_index_columns = True #merges on the entity id and timestamp columns
     merge_method = 'outer' #or nearest, concat
     #use concat when the source time series contains the same metrics as the entity type source data
     #use nearest to align the source time series to the entity source data
@@ -1401,11 +1470,29 @@ class BaseDataSource(BaseTransformer):
         raise NotImplementedError('You must implement a get_data() method for any class that acts as a data source')
             
         
+    def get_prefetch_task(self,df):
+        
+        return self._get_source_data
+    
+    @timed_service_call('db')
+    def _get_source_data(self):
+        '''
+        Retrieve the additional data. Data retrieval is recorded and replayed as a service call.
+        '''
+        return self.get_data(start_ts=None,end_ts=None,entities=None)
+        
     def execute(self,df,start_ts=None,end_ts=None,entities=None):        
         '''
         Retrieve data and combine with pipeline data
         '''
-        new_df = self.get_data(start_ts=None,end_ts=None,entities=None)
+        new_df = self.pop_prefetched_data()
+        if new_df is None:
+            new_df = self._get_source_data()
+        if self.get_entity_type_param('_encode_entity_ids'):
+            #joins on encoded entity ids require the same dictionary on both sides
+            #encoding new_df may add ids to the dictionary so df is encoded again
+            new_df = self._entity_type.encode_df_entity_ids(new_df)
+            df = self._entity_type.encode_df_entity_ids(df.copy(deep = False))
         self.log_df_info(df,'source dataframe before merge')
         self.log_df_info(new_df,'additional data source to be merged')        
         overlapping_columns = list(set(new_df.columns.intersection(set(df.columns))))
@@ -1491,6 +1578,7 @@ class BaseAggregator(BaseFunction):
     """
     
     category =  'AGGREGATOR'
+    is_cross_entity = True
     
     def __init__(self):
         super().__init__()
@@ -1505,6 +1593,8 @@ class BaseDatabaseLookup(BaseTransformer):
     data should be provided as a dictionary and used to create a DataFrame
     '''
     data = None
+    is_cacheable = False
+    is_cross_entity = True #queries the database. Not executed in entity partitions
     #Even this function returns new data to the pipeline, it is not considered a data source
     #as it behaves like any other transformer, ie: adds columns not rows to the pipeline
     is_data_source = False
@@ -1562,20 +1652,7 @@ class BaseDatabaseLookup(BaseTransformer):
         Execute transformation function of DataFrame to return a DataFrame
         '''                
         self.db = self.get_db()
-        if self._auto_create_lookup_table:
-            self.create_lookup_table(df=None,table_name=self.lookup_table_name)
-            
-        if self.sql is None:
-            query, table = self._entity_type.db.query(table_name = self.lookup_table_name,
-                                                      schema = self._entity_type._db_schema)
-            self.sql = query.statement
-
-        msg = ' function attempted to excecute sql %s. ' %self.sql
-        self.trace_append(msg)
-        df_sql = pd.read_sql(self.sql, 
-                             self.db.connection,
-                             index_col=self.lookup_keys,
-                             parse_dates=self.parse_dates)
+        df_sql = self.get_lookup_data()
         msg = 'Lookup returned columns %s. ' %','.join(list(df_sql.columns))
         self.trace_append(msg)
         
@@ -1590,6 +1667,26 @@ class BaseDatabaseLookup(BaseTransformer):
 
         return df
     
+    @timed_service_call('db')
+    def get_lookup_data(self):
+        '''
+        Retrieve the contents of the lookup table indexed on the lookup keys
+        '''
+        if self._auto_create_lookup_table:
+            self.create_lookup_table(df=None,table_name=self.lookup_table_name)
+            
+        if self.sql is None:
+            query, table = self._entity_type.db.query(table_name = self.lookup_table_name,
+                                                      schema = self._entity_type._db_schema)
+            self.sql = query.statement
+
+        msg = ' function attempted to excecute sql %s. ' %self.sql
+        self.trace_append(msg)
+        return pd.read_sql(self.sql, 
+                           self.db.connection,
+                           index_col=self.lookup_keys,
+                           parse_dates=self.parse_dates)
+    
     def create_lookup_table(self,df=None, table_name=None):
         '''
         Create and populate lookup table
@@ -1682,31 +1779,27 @@ class BaseDBActivityMerge(BaseDataSource):
                     entities = None):
         
         dfs = []
-        #build sql and execute it 
+        tasks = []
+        sources = []
+        #build sql for each activity table and activity
         for table_name,activities in list(self.activities_metadata.items()):
             for a in activities:
-                af = self.read_activity_data(table_name=table_name,
-                                   activity_code=a,
-                                   start_ts = start_ts,
-                                   end_ts = end_ts,
-                                   entities = entities)
-                
-                af[self._activity] = a
-                msg = 'Read activity table %s' %table_name
-                self.log_df_info(af,msg)
-                dfs.append(af)
-                self.available_non_activity_cols.append(self._get_non_activity_cols(af))
-        #execute sql provided explictly
+                tasks.append(functools.partial(self.read_activity_data,
+                                               table_name=table_name,
+                                               activity_code=a,
+                                               start_ts = start_ts,
+                                               end_ts = end_ts,
+                                               entities = entities))
+                sources.append((a,'Read activity table %s' %table_name))
+        #sql provided explictly
         for activity, sql in list(self.activities_custom_query_metadata.items()):
-            try:
-                af = pd.read_sql(sql,
-                                 con = self._entity_type.db.connection,
-                                 parse_dates=[self._start_date,self._end_date])
-            except:
-                logger.warning('Function attempted to retrieve data for a merge operation using custom sql. There was a problem with this retrieval operation. Confirm that the sql is valid and contains column aliases for start_date,end_date and device_id')
-                logger.warning(sql)
-                raise 
-            af[self._activity] = activity
+            tasks.append(functools.partial(self._read_custom_activity_data,sql=sql))
+            sources.append((activity,None))
+        #execute all queries concurrently
+        for ((a,msg),af) in zip(sources,self.fetch_concurrently(tasks)):
+            af[self._activity] = a
+            if msg is not None:
+                self.log_df_info(af,msg)
             dfs.append(af)
             self.available_non_activity_cols.append(self._get_non_activity_cols(af))
             
@@ -1756,7 +1849,7 @@ class BaseDBActivityMerge(BaseDataSource):
                         group_base.append(pd.Grouper(axis=0, level=adf.index.names.index(s)))
                 levels.append(s)
             try:
-                group = adf.groupby(group_base)             
+                group = adf.groupby(group_base,observed=True)             
             except KeyError:
                 msg = 'Attempt to execute combine activities by %s. One or more group by column was not found' %levels
                 logger.debug(msg)
@@ -1906,6 +1999,7 @@ class BaseDBActivityMerge(BaseDataSource):
             cols.extend(scd_properties)
         return pd.DataFrame(columns = cols)
                 
+    @timed_service_call('db')
     def read_activity_data(self,table_name,activity_code,start_ts=None,end_ts=None,entities=None):
         """
         Issue a query to return a dataframe. Subject is an activity table with columns: deviceid, start_date, end_date, activity
@@ -1942,6 +2036,19 @@ class BaseDBActivityMerge(BaseDataSource):
                          parse_dates=[self._start_date,self._end_date])
         
         return df
+    
+    @timed_service_call('db')
+    def _read_custom_activity_data(self,sql):
+        
+        try:
+            af = pd.read_sql(sql,
+                             con = self._entity_type.db.connection,
+                             parse_dates=[self._start_date,self._end_date])
+        except:
+            logger.warning('Function attempted to retrieve data for a merge operation using custom sql. There was a problem with this retrieval operation. Confirm that the sql is valid and contains column aliases for start_date,end_date and device_id')
+            logger.warning(sql)
+            raise
+        return af
 
 
 class BaseSCDLookup(BaseTransformer):
@@ -1952,6 +2059,9 @@ class BaseSCDLookup(BaseTransformer):
     _end_date = 'end_date'
     merge_nearest_tolerance = None # or something like pd.Timedelta('1D')
     is_scd_lookup = True
+    is_cacheable = False
+    is_cross_entity = True #queries the database. Not executed in entity partitions
+    requires_index_columns = True
     
     def __init__ (self, table_name, output_item = None):
         
@@ -1962,14 +2072,21 @@ class BaseSCDLookup(BaseTransformer):
         super().__init__()
         self.itemTags['output_item'] = ['DIMENSION']
         
+    def get_prefetch_task(self,df):
+        
+        (start_ts, end_ts, entities) = self._get_data_scope(df)
+        return functools.partial(self.get_scd_data,table_name = self.table_name, start_ts = start_ts, end_ts=end_ts, entities=entities)
+        
     def execute(self,df):
         
         msg = 'Starting scd lookup of %s from table %s. ' %(self.output_item,self.table_name)
         msg = self.log_df_info(df,msg) 
         self.trace_append(msg)
         
-        (start_ts, end_ts, entities) = self._get_data_scope(df)
-        resource_df = self.get_scd_data(table_name = self.table_name, start_ts = start_ts, end_ts=end_ts, entities=entities)
+        resource_df = self.pop_prefetched_data()
+        if resource_df is None:
+            (start_ts, end_ts, entities) = self._get_data_scope(df)
+            resource_df = self.get_scd_data(table_name = self.table_name, start_ts = start_ts, end_ts=end_ts, entities=entities)
         msg = 'df for resource lookup' 
         msg = self.log_df_info(resource_df,msg) + '. '
         self.trace_append(msg)       
@@ -1983,6 +2100,11 @@ class BaseSCDLookup(BaseTransformer):
         
         resource_df = resource_df.rename(columns = {scd_property:self.output_item,
                                           'start_date': self._entity_type._timestamp})
+        if self.get_entity_type_param('_encode_entity_ids'):
+            #resource_df may contain ids that are not in df. df is encoded again
+            #so that both sides have the same dictionary
+            resource_df = self._entity_type.encode_df_entity_ids(resource_df)
+            df = self._entity_type.encode_df_entity_ids(df.copy(deep = False))
         cols = [x for x in resource_df.columns if x not in ['end_date']]
         resource_df = resource_df[cols]
         try:
@@ -2025,6 +2147,7 @@ class BasePreload(BaseTransformer):
     They are monitored. Excessive resource consumption will be billed by estimating an equivalent number of function executions. 
     """
     is_preload = True
+    is_independent = False #preload does not depend on other preload stages. Consecutive independent preloads execute concurrently
     
     def __init__(self, dummy_items, output_item = None):
         super().__init__()
@@ -2062,6 +2185,7 @@ class BaseMetadataProvider(BasePreload):
     Metadata providers do not transform data. They merely add metadata to the entity type
     to make it available to other functions in the pipeline.
     """
+    is_independent = True
     
     def __init__(self, dummy_items, output_item = 'is_parameters_set', **kwargs):
         super().__init__(dummy_items = dummy_items, output_item= output_item)
@@ -2082,6 +2206,7 @@ class BaseEstimatorFunction(BaseTransformer):
     compatible estimators.
     '''
     shelf_life_days = None
+    is_cacheable = False
     # Train automatically
     auto_train = True
     experiments_per_execution = 1
@@ -2096,6 +2221,8 @@ class BaseEstimatorFunction(BaseTransformer):
     acceptable_score_for_model_acceptance = 0
     greater_is_better = True
     version_model_writes = False
+    # train on data from all entities
+    is_cross_entity = True
     def __init__(self, features, targets, predictions):
         self.features = features
         self.targets = targets
@@ -2210,7 +2337,7 @@ class BaseEstimatorFunction(BaseTransformer):
             self._entity_type.db.cos_delete(m, bucket= self.get_bucket_name())
         
     def execute(self, df):
-        df  = df.copy()
+        df  = self.copy_df(df)
         db = self._entity_type.db
         bucket = self.get_bucket_name()
         # transform incoming data using any preprocessors
@@ -0,0 +1,281 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+'''
+Record a pipeline execution into a self contained bundle and replay it offline.
+
+A bundle contains the source dataframe read by the pipeline, the stages, the
+entity type params and scalar constants and the results of every database, COS
+and http call made by the stages. Replaying a bundle serves these calls from the bundle and reports the execution time and
+output checksum of each stage so that the performance of a production pipeline
+can be measured without access to production systems.
+'''
+
+import gzip
+import importlib
+import logging
+import dill as pickle
+import pandas as pd
+from .db import Database
+from .metadata import EntityType
+from .pipeline import PipelineExpression
+from .util import ServiceRecorder, set_service_recorder
+
+logger = logging.getLogger(__name__)
+
+# entity type attributes that are rebuilt when the bundle is replayed
+EXCLUDED_PARAMS = ['db','table','activity_tables','scd','tenant_id','_trace',
+                   '_stages','_dimension_table','_scd_stages','_custom_calendar',
+                   '_constants','_is_initial_transform',
+                   '_is_preload_complete','_stage_type_map','_entity_id_lock']
+
+# types of constants that are stored in the bundle
+CONSTANT_TYPES = (str,int,float,bool,type(None))
+
+# stage attributes that are set outside of the stage constructor
+STAGE_ATTRIBUTES = ['name','_input_set','_output_list','_schedule','_granularity']
+
+
+class ReplayDatabase(Database):
+    '''
+    Database object used to replay a recorded bundle. It does not connect to
+    a database. Service calls are served from the bundle.
+    '''
+
+    def __init__(self,tenant_id = None):
+        self.tenant_id = tenant_id
+        self.credentials = {'tenant_id' : tenant_id,
+                            'config' : {'bos_runtime_bucket' : None}}
+        self.function_catalog = {}
+        self.write_chunk_size = 1000
+        self.connection = None
+        self.session = None
+        self.cos_client = None
+
+    def get_table(self,table_name,schema=None):
+
+        msg = 'Table %s is not available when replaying a recorded pipeline' %table_name
+        logger.debug(msg)
+        return None
+
+    def http_request(self, object_type, object_name, request, payload=None, object_name_2='', raise_error = False):
+
+        # entity type params are restored from the bundle
+        if object_type == 'constants':
+            return None
+        return super().http_request(object_type = object_type, object_name = object_name,
+                                    request = request, payload = payload,
+                                    object_name_2 = object_name_2, raise_error = raise_error)
+
+    def start_session(self):
+
+        pass
+
+    def commit(self):
+
+        pass
+
+
+def get_entity_type_params(entity_type):
+    '''
+    Get a dict of the params of an entity type that can be stored in a bundle
+    '''
+    params = {}
+    for key,value in list(vars(entity_type).items()):
+        if key in EXCLUDED_PARAMS:
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            msg = 'Entity type param %s cannot be stored in the bundle' %key
+            logger.debug(msg)
+        else:
+            params[key] = value
+    return params
+
+
+def get_constants(entity_type):
+    '''
+    Get a dict of the scalar constants of an entity type that can be stored in a bundle
+    '''
+    constants = {}
+    for key,value in list(entity_type.get_constants().items()):
+        if key in EXCLUDED_PARAMS or not isinstance(value,CONSTANT_TYPES):
+            continue
+        constants[key] = value
+    return constants
+
+
+def get_stage_metadata(stage):
+    '''
+    Get a dict describing how to rebuild a stage
+    '''
+    if isinstance(stage,PipelineExpression):
+        args = {'expression' : stage.expression, 'name' : stage.name}
+    else:
+        args = stage._get_arg_metadata(isoformat_dates = False)
+    metadata = {'module' : stage.__class__.__module__,
+                'class' : stage.__class__.__name__,
+                'args' : args,
+                'attributes' : {}}
+    for a in STAGE_ATTRIBUTES:
+        try:
+            metadata['attributes'][a] = getattr(stage,a)
+        except AttributeError:
+            pass
+    return metadata
+
+
+def build_stage(metadata,entity_type):
+    '''
+    Rebuild a stage from its metadata
+    '''
+    cls = getattr(importlib.import_module(metadata['module']),metadata['class'])
+    if cls is PipelineExpression:
+        stage = cls(entity_type = entity_type, **metadata['args'])
+    else:
+        stage = cls(**metadata['args'])
+    for key,value in list(metadata['attributes'].items()):
+        setattr(stage,key,value)
+    return stage
+
+
+def get_stage_checksums(df,stages):
+    '''
+    Get a dict keyed on stage name containing a checksum of the output items of
+    each stage that are present in the dataframe
+    '''
+    checksums = {}
+    for s in stages:
+        name = getattr(s,'name',s.__class__.__name__)
+        outputs = [x for x in (getattr(s,'_output_list',None) or []) if x in df.columns]
+        if not outputs:
+            continue
+        total = int(pd.util.hash_pandas_object(df[outputs],index=True).sum())
+        checksums[name] = '%016x' %(total & 0xFFFFFFFFFFFFFFFF)
+    return checksums
+
+
+def get_report(pipeline,df,stages,baseline = None):
+    '''
+    Get a dict containing the stage profile and output checksums of an execution.
+    When a baseline report is supplied, include a comparison with it.
+    '''
+    report = pipeline.get_profile()
+    if report is None:
+        report = {'stages' : [], 'totals' : {}}
+    report['checksums'] = get_stage_checksums(df,stages)
+    if baseline is not None:
+        report['baseline_totals'] = baseline['totals']
+        report['checksum_mismatches'] = [x for x in report['checksums']
+                                         if baseline['checksums'].get(x) != report['checksums'][x]]
+        baseline_time = baseline['totals'].get('wall_time')
+        replay_time = report['totals'].get('wall_time')
+        if baseline_time and replay_time:
+            report['speedup'] = baseline_time / replay_time
+    return report
+
+
+def record_pipeline(entity_type, filename, stages = None, start_ts = None, end_ts = None, entities = None):
+    '''
+    Execute a pipeline and record it into a bundle file.
+    When no stages are supplied, the input level stages loaded from the server are recorded.
+    The source data is read by the pipeline after its preload stages have run.
+    Returns the report of the recorded execution.
+    '''
+    if stages is None:
+        stages = []
+        for (stage_type,granularity),level_stages in list(entity_type._stages.items()):
+            if granularity is None:
+                stages.extend([s for s in level_stages if hasattr(s,'_get_arg_metadata')])
+    preloaded_item_names = []
+    transform_stages = []
+    for s in stages:
+        if getattr(s,'is_preload',False):
+            preloaded_item_names.append(s.output_item)
+        else:
+            transform_stages.append(s)
+    pipeline = entity_type.get_calc_pipeline(stages=stages)
+    bundle = {'name' : entity_type.name,
+              'tenant_id' : entity_type.tenant_id,
+              'params' : get_entity_type_params(entity_type),
+              'constants' : get_constants(entity_type),
+              'stages' : [get_stage_metadata(s) for s in transform_stages],
+              'preloaded_item_names' : preloaded_item_names,
+              'start_ts' : start_ts,
+              'end_ts' : end_ts,
+              'entities' : entities}
+    recorder = ServiceRecorder()
+    profile_stages = entity_type._profile_stages
+    incremental = entity_type._incremental
+    entity_type._profile_stages = True
+    # replay does not apply checkpoints so the recorded read must not either
+    entity_type._incremental = False
+    set_service_recorder(recorder)
+    try:
+        df = pipeline.execute(start_ts=start_ts, end_ts=end_ts, entities=entities)
+    finally:
+        set_service_recorder(None)
+        entity_type._profile_stages = profile_stages
+        entity_type._incremental = incremental
+    # the source data read by the pipeline is stored once as the source of the bundle
+    prefix = '%s(' %EntityType.get_data.__qualname__
+    reads = [x for x in recorder.calls if x.startswith(prefix)]
+    if len(reads) == 0:
+        msg = 'The pipeline did not read source data. Nothing was recorded to %s' %filename
+        raise ValueError(msg)
+    bundle['source'] = recorder.calls[reads[0]][0]
+    for key in reads:
+        del recorder.calls[key]
+    bundle['calls'] = recorder.calls
+    bundle['report'] = get_report(pipeline,df,transform_stages)
+    with gzip.open(filename,'wb') as f:
+        pickle.dump(bundle,f)
+    msg = 'Recorded %s stages and %s service calls to %s' %(len(transform_stages),len(recorder.calls),filename)
+    logger.info(msg)
+    return bundle['report']
+
+
+def load_bundle(filename):
+    '''
+    Load a recorded bundle file
+    '''
+    with gzip.open(filename,'rb') as f:
+        return pickle.load(f)
+
+
+def replay_pipeline(filename, strict = False, **params):
+    '''
+    Replay a recorded bundle without access to the database, COS or the AS API.
+    Additional params are set on the entity type, e.g. to compare the performance
+    of execution options. When strict, a service call that was not recorded
+    raises an error. Returns a report that compares the execution with the recording.
+    '''
+    bundle = load_bundle(filename)
+    recorder = ServiceRecorder(calls = bundle['calls'], replay = True, strict = strict)
+    set_service_recorder(recorder)
+    try:
+        entity_type = EntityType(bundle['name'], ReplayDatabase(tenant_id = bundle['tenant_id']))
+        entity_type.set_params(**bundle['params'])
+        entity_type.set_params(_profile_stages = True, _incremental = False, _stage_cache_dir = None)
+        entity_type.set_params(**params)
+        entity_type.get_constants().update(bundle['constants'])
+        stages = [build_stage(x,entity_type) for x in bundle['stages']]
+        pipeline = entity_type.get_calc_pipeline(stages=stages)
+        df = pipeline.execute(df = bundle['source'].copy(),
+                              start_ts = bundle['start_ts'],
+                              end_ts = bundle['end_ts'],
+                              entities = bundle['entities'],
+                              preloaded_item_names = list(bundle['preloaded_item_names']))
+    finally:
+        set_service_recorder(None)
+    report = get_report(pipeline,df,stages,baseline = bundle['report'])
+    report['missing_calls'] = recorder.misses
+    return report
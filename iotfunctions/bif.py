@@ -24,6 +24,7 @@ import iotfunctions as iotf
 from .metadata import EntityType
 from .base import BaseTransformer, BaseEvent, BaseSCDLookup, BaseMetadataProvider, BasePreload, BaseDatabaseLookup, BaseDataSource, BaseDBActivityMerge
 from .ui import UISingle,UIMultiItem,UIFunctionOutSingle, UISingleItem, UIFunctionOutMulti, UIMulti
+from .util import compile_expression
 
 logger = logging.getLogger(__name__)
 PACKAGE_URL = 'git+https://github.com/ibm-watson-iot/functions.git@'
@@ -67,6 +68,8 @@ class IoTAlertExpression(BaseEvent):
     '''
     Create alerts that are triggered when data values reach a particular range.
     '''
+    has_side_effects = False
+
     def __init__(self, input_items, expression , alert_name):
         self.input_items = input_items
         self.expression = expression
@@ -85,16 +88,16 @@ class IoTAlertExpression(BaseEvent):
         return df
         
     def execute(self, df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
-        if '${' in self.expression:
-            expr = re.sub(r"\$\{(\w+)\}", r"df['\1']", self.expression)
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
+        expr = compile_expression(self.expression)
+        if expr.source != self.expression:
             msg = 'Expression converted to %s. ' %expr
         else:
-            expr = self.expression
             msg = 'Expression (%s). ' %expr
         self.trace_append(msg)
-        df[self.alert_name] = np.where(eval(expr), True, False)
+        result = expr.evaluate(df, local_dict = {'c' : c, 'self' : self}, global_dict = globals())
+        df[self.alert_name] = np.where(result, True, False)
         return df
     
     @classmethod
@@ -122,6 +125,9 @@ class IoTAlertOutOfRange(BaseEvent):
     """
     Fire alert when metric exceeds an upper threshold or drops below a lower_theshold. Specify at least one threshold.
     """
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,input_item, lower_threshold=None, upper_threshold=None,
                   output_alert_upper = 'output_alert_upper', output_alert_lower = 'output_alert_lower'):
@@ -143,8 +149,8 @@ class IoTAlertOutOfRange(BaseEvent):
         '''        
         
     def execute(self,df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
         df[self.output_alert_upper] = False
         df[self.output_alert_lower] = False
         
@@ -191,6 +197,9 @@ class IoTAlertHighValue(BaseEvent):
     """
     Fire alert when metric exceeds an upper threshold'.
     """
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,input_item,  upper_threshold=None,
                   alert_name = 'alert_name', ):
@@ -205,8 +214,8 @@ class IoTAlertHighValue(BaseEvent):
         '''        
         
     def execute(self,df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
         df[self.alert_name] = np.where(df[self.input_item]>=self.upper_threshold,True,False)
             
         return df  
@@ -241,6 +250,9 @@ class IoTAlertLowValue(BaseEvent):
     """
     Fire alert when metric goes below a threshold'.
     """
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,input_item,  lower_threshold=None,
                   alert_name = 'alert_name', ):
@@ -256,8 +268,8 @@ class IoTAlertLowValue(BaseEvent):
         return df        
         
     def execute(self,df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
         df[self.alert_name] = np.where(df[self.input_item]<=self.lower_threshold,True,False)
             
         return df
@@ -291,6 +303,8 @@ class IoTAutoTest(BaseTransformer):
     The test will compare columns calculated values with values in the test dataset.
     Discepancies will the written to a test output file.
     '''
+    is_cross_entity = True
+    is_cacheable = False
     
     def __init__(self,test_datset_name,columns_to_test,result_col='test_result'):
         
@@ -469,6 +483,9 @@ class IoTCoalesceDimension(BaseTransformer):
     """
     Return first non-null value from a list of data items.
     """
+    is_cacheable = True
+    has_side_effects = False
+
     def __init__(self,data_items, output_item = 'output_item'):
         
         super().__init__()
@@ -497,6 +514,8 @@ class IoTConditionalItems(BaseTransformer):
     Set the value of a data item based on the value of a conditional expression 
     eg. if df["sensor_is_valid"]==True then df["temp"] and df["pressure"] are valid else null
     """
+    has_side_effects = False
+
     def __init__(self,conditional_expression, conditional_items, output_items = None):
         
         super().__init__()
@@ -507,9 +526,10 @@ class IoTConditionalItems(BaseTransformer):
         self.output_items = output_items
         
     def execute(self,df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
-        result  = eval(self.conditional_expression)
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
+        expr = compile_expression(self.conditional_expression)
+        result  = expr.evaluate(df, local_dict = {'c' : c, 'self' : self}, global_dict = globals())
         for i,o in enumerate(self.conditional_items):
             df[self.output_items[i]] = np.where(result,df[o],None)
         return df
@@ -544,6 +564,7 @@ class IoTCosFunction(BaseTransformer):
     """
     Execute a serialized function retrieved from cloud object storage. Function returns a single output.
     """        
+    is_cacheable = False
     
     def __init__(self,function_name,input_items,output_item='output_item',parameters=None):
         
@@ -578,7 +599,7 @@ class IoTCosFunction(BaseTransformer):
                                bucket=bucket,
                                binary=True)
         #execute
-        df = df.copy()
+        df = self.copy_df(df)
         rf = function(df,self.parameters)
         #rf will contain the orginal columns along with a single new output column.
         return rf
@@ -609,6 +630,9 @@ class DateDifference(BaseTransformer):
     """
     Calculate the difference between two date data items in days,ie: ie date_2 - date_1
     """
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,date_1,date_2,num_days='num_days'):
         
@@ -676,6 +700,8 @@ class DateDifferenceReference(BaseTransformer):
     Calculate the difference between a data item and a reference value,
     ie: ie ref_date - date_1
     """
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,date_1,ref_date,num_days='num_days'):
         
@@ -734,6 +760,8 @@ class DateDifferenceConstant(BaseTransformer):
     Calculate the difference between a data item and a constant_date,
     ie: ie constant_date - date_1
     """
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__ (self,date_1,date_constant,num_days='num_days'):
         
@@ -752,7 +780,7 @@ class DateDifferenceConstant(BaseTransformer):
         else:
             ds_1 = df[self.date_1]    
         
-        c = self._entity_type.get_attributes_dict()
+        c = self._entity_type.get_constants()
         constant_value = c[self.date_constant]
         ds_2 = pd.Series(data=constant_value,index=df.index)
         ds_2 = pd.to_datetime(ds_2)
@@ -936,7 +964,7 @@ class IoTEntityDataGenerator(BasePreload):
     Time series columns defined on the entity data table will be populated
     with random data.
     """
-    
+    is_independent = True
     freq = '5min' 
     # ids of entities to generate. Change the value of the range() function to change the number of entities
     
@@ -1035,6 +1063,7 @@ class IoTExpression(BaseTransformer):
     '''
     Create a new item from an expression involving other items
     '''
+    has_side_effects = False
     
     def __init__(self, expression , output_name):
         self.output_name = output_name
@@ -1047,14 +1076,15 @@ class IoTExpression(BaseTransformer):
         
                 
     def execute(self, df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
         requested = list(self.get_input_items())
         msg = self.expression + ' .'
         self.trace_append(msg)
         msg = 'Function requested items: %s . ' %','.join(requested)
         self.trace_append(msg)
-        df[self.output_name] = eval(self.expression)
+        expr = compile_expression(self.expression)
+        df[self.output_name] = expr.evaluate(df, local_dict = {'c' : c, 'self' : self}, global_dict = globals())
         return df
     
     def get_input_items(self):
@@ -1142,6 +1172,8 @@ class IoTEntityId(BaseTransformer):
     Deliver a data item containing the id of each entity. Optionally only return the entity
     id when one or more data items are populated, else deliver a null value.
     """
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self,data_items=None,output_item = 'entity_id'):
         
@@ -1151,12 +1183,13 @@ class IoTEntityId(BaseTransformer):
         
     def execute(self,df):
         
-        df = df.copy()
+        df = self.copy_df(df)
+        entity_ids = self.get_entity_id_series(df)
         if self.data_items is None:
-            df[self.output_item] = df[self.get_entity_type()._entity_id]
+            df[self.output_item] = entity_ids
         else:
             df[self.output_item] = np.where(df[self.data_items].notna().max(axis=1),
-                                        df[self.get_entity_type()._entity_id],
+                                        entity_ids,
                                         None)
         return df    
         
@@ -1182,6 +1215,7 @@ class IoTIfThenElse(BaseTransformer):
     """
     Set the value of a data item based on the value of a conditional expression
     """
+    has_side_effects = False
     
     def __init__(self,conditional_expression, true_expression, false_expression, output_item = 'output_item'):
         
@@ -1192,11 +1226,12 @@ class IoTIfThenElse(BaseTransformer):
         self.output_item = output_item
         
     def execute(self,df):
-        c = self._entity_type.get_attributes_dict()
-        df = df.copy()
-        df[self.output_item] = np.where(eval(self.conditional_expression),
-                                        eval(self.true_expression),
-                                        eval(self.false_expression))
+        c = self._entity_type.get_constants()
+        df = self.copy_df(df)
+        names = {'c' : c, 'self' : self}
+        results = [compile_expression(x).evaluate(df, local_dict = names, global_dict = globals())
+                   for x in [self.conditional_expression, self.true_expression, self.false_expression]]
+        df[self.output_item] = np.where(*results)
         return df
     
     @classmethod
@@ -1225,13 +1260,14 @@ class IoTIfThenElse(BaseTransformer):
         return (inputs,outputs)
     
     def get_input_items(self):
-        items = self.get_expression_items(self.conditional_expression, self.true_expression, self.false_expression)
+        items = self.get_expression_items([self.conditional_expression, self.true_expression, self.false_expression])
         return items    
                 
 class IoTPackageInfo(BaseTransformer):
     """
     Show the version of a list of installed packages. Optionally install packages that are not installed.
     """
+    is_cacheable = False
     
     def __init__ (self, package_names,add_to_trace=True, install_missing = True, version_output = None):
         
@@ -1246,7 +1282,7 @@ class IoTPackageInfo(BaseTransformer):
     def execute(self,df):
         import importlib
         entity_type = self.get_entity_type()
-        df = df.copy()
+        df = self.copy_df(df)
         for i,p in enumerate(self.package_names):
             ver = ''
             try:
@@ -1300,6 +1336,7 @@ class IoTRaiseError(BaseTransformer):
     By halting execution of the pipeline you can view useful diagnostic information in an error
     message displayed in the UI.
     """
+    is_cacheable = False
     def __init__(self,halt_after, 
                  abort_execution = True,
                  output_item = 'pipeline_exception'):
@@ -1342,6 +1379,7 @@ class IoTRandomNormal(BaseTransformer):
     """
     Generate a normally distributed random number.
     """
+    is_cacheable = False
     
     def __init__ (self, mean, standard_deviation, output_item = 'output_item'):
         
@@ -1376,6 +1414,7 @@ class IoTRandomChoice(BaseTransformer):
     """
     Generate a random categorical value.
     """
+    is_cacheable = False
     
     def __init__ (self, domain_of_values, output_item = 'output_item'):
         
@@ -1409,6 +1448,8 @@ class IoTSaveCosDataFrame(BaseTransformer):
     """
     Serialize dataframe to COS
     """
+    is_cross_entity = True
+    is_cacheable = False
     
     def __init__(self,
                  filename='job_output_df',
@@ -1419,6 +1460,9 @@ class IoTSaveCosDataFrame(BaseTransformer):
         self.filename = filename
         self.columns = columns
         self.output_item = output_item
+        if columns is None:
+            # saves the whole dataframe
+            self.requires_all_source_items = True
         
     def execute(self,df):
         
@@ -1475,6 +1519,7 @@ class IoTShiftCalendar(BaseTransformer):
     
     is_custom_calendar = True
     auto_conform_index = True
+    requires_index_columns = True
     def __init__ (self,shift_definition=None,
                   period_start_date = 'shift_start_date',
                   period_end_date = 'shift_end_date',
@@ -1552,6 +1597,7 @@ class IoTSleep(BaseTransformer):
     """
     Wait for the designated number of seconds
     """
+    is_cacheable = False
     def __init__(self,sleep_after, 
                  sleep_duration_seconds = 30,
                  output_item = 'sleep_status'):
@@ -1594,6 +1640,7 @@ class IoTTraceConstants(BaseTransformer):
     """
     Write the values of available constants to the trace
     """         
+    is_cacheable = False
     
     def __init__(self,dummy_items,output_item = 'trace_written'):
         
@@ -1604,7 +1651,7 @@ class IoTTraceConstants(BaseTransformer):
         
     def execute(self,df):
         
-        c = self._entity_type.get_attributes_dict()
+        c = self._entity_type.get_constants()
         msg = 'entity constants retrieved'
         self.trace_append(msg,**c)
             
@@ -1633,6 +1680,8 @@ class TimestampCol(BaseTransformer):
     """
     Deliver a data item containing the timestamp
     """
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self,dummy_items=None,output_item = 'timestamp_col'):
         
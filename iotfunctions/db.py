@@ -16,13 +16,13 @@ import json
 import inspect
 import pandas as pd
 import subprocess
-from pandas.api.types import is_string_dtype, is_numeric_dtype, is_bool_dtype, is_datetime64_any_dtype, is_dict_like
+from pandas.api.types import is_string_dtype, is_numeric_dtype, is_bool_dtype, is_datetime64_any_dtype, is_dict_like, is_categorical_dtype
 from sqlalchemy import Table, Column, Integer, SmallInteger, String, DateTime, MetaData, ForeignKey, create_engine, Float, func, and_, or_
 from sqlalchemy.sql.sqltypes import TIMESTAMP,VARCHAR
 from sqlalchemy.sql import select
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.exc import NoSuchTableError
-from .util import CosClient, resample
+from .util import CosClient, resample, timed_service_call
 from . import metadata as md
 from . import pipeline as pp
 
@@ -308,6 +308,7 @@ class Database(object):
                 msg = 'Column %s not found on time series or dimension table.' %column
                 raise ValueError(msg)        
 
+    @timed_service_call('cos')
     def cos_load(self, filename, bucket=None, binary=False):
         if bucket is None:
             bucket = self.credentials['config']['bos_runtime_bucket']        
@@ -319,11 +320,17 @@ class Database(object):
             logger.error('Not able to GET %s from COS bucket %s' % (filename, bucket))
         return obj
     
-    def cos_save(self, persisted_object, filename, bucket=None, binary=False):
+    @timed_service_call('cos')
+    def cos_save(self, persisted_object, filename, bucket=None, binary=False, serialize=True):
+        '''
+        Save an object to COS. Objects are pickled unless serialize is False,
+        in which case a str or bytes object is uploaded as is.
+        '''
         if bucket is None:
             bucket = self.credentials['config']['bos_runtime_bucket']
         if self.cos_client is not None:
-            ret = self.cos_client.cos_put(key=filename, payload=persisted_object, bucket=bucket, binary=binary)
+            ret = self.cos_client.cos_put(key=filename, payload=persisted_object, bucket=bucket, binary=binary,
+                                          serialize=serialize)
         else:
             ret = None
         if ret is None:
@@ -528,6 +535,7 @@ class Database(object):
         return [column.key for column in table.columns]
     
     
+    @timed_service_call('http')
     def http_request(self,
                      object_type,
                      object_name,
@@ -841,6 +849,7 @@ class Database(object):
                 con.execute('SET ISOLATION TO DIRTY READ;')  #specific for DB2
     
     
+    @timed_service_call('db')
     def get_query_data(self, query):
         '''
         Execute a query and a return a dataframe containing results
@@ -878,6 +887,7 @@ class Database(object):
         logger.debug(msg)      
         
         
+    @timed_service_call('db')
     def read_table(self,table_name,
                    schema,
                    parse_dates = None,
@@ -886,11 +896,12 @@ class Database(object):
                    start_ts = None,
                    end_ts = None,
                    entities = None,
-                   dimension = None
+                   dimension = None,
+                   not_null_columns = None
                    ):
         '''
         Read whole table and return as dataframe
-        
+
         Parameters
         -----------
         table_name: str
@@ -911,8 +922,9 @@ class Database(object):
             Table name for dimension table. Dimension table will be joined on deviceid. 
         parse_dates: list of strs
             Column names to parse as dates
-        
-        
+        not_null_columns: list of strs
+            Only retrieve rows where at least one of these columns is not null
+
         '''
         q,table = self.query(table_name,
                              schema=schema,
@@ -922,9 +934,16 @@ class Database(object):
                              end_ts = end_ts,
                              entities = entities,
                              dimension = dimension)
+        if not_null_columns:
+            dim = None
+            if dimension is not None:
+                dim = self.get_table(table_name=dimension,schema=schema)
+            #filter out rows where all of the columns are null
+            q = q.filter(or_(*[self._is_not_null(table=table, dimension_table = dim, column = c) for c in not_null_columns]))
         df = pd.read_sql(sql=q.statement,con=self.connection,parse_dates=parse_dates,columns=columns)
         return(df)
         
+    @timed_service_call('db')
     def read_sql(self,sql,parse_dates =None,columns=None):
         '''
         Read whole table and return as dataframe
@@ -932,6 +951,7 @@ class Database(object):
         df = pd.read_sql(sql,con=self.connection,parse_dates=parse_dates,columns=columns)
         return(df)
 
+    @timed_service_call('db')
     def read_query(self,query,parse_dates =None,columns=None):
         '''
         Read whole table and return as dataframe
@@ -945,6 +965,7 @@ class Database(object):
         df = pd.read_sql(query,con=self.connection,parse_dates=parse_dates,columns=columns)
         return(df)
         
+    @timed_service_call('db')
     def read_agg(self, table_name, schema, agg_dict,
                        agg_outputs = None,
                        groupby=None,
@@ -1489,6 +1510,7 @@ class Database(object):
         logger.info(msg) 
         
     
+    @timed_service_call('db')
     def write_frame(self,df,
                     table_name, 
                     version_db_writes = False,
@@ -1538,6 +1560,9 @@ class Database(object):
         dtypes = {}        
         #replace default mappings to clobs and booleans
         for c in list(df.columns):
+            if is_categorical_dtype(df[c]):
+                #decode dictionary encoded entity ids
+                df[c] = df[c].astype(object)
             if is_string_dtype(df[c]):
                 dtypes[c] = String(255)
             elif is_bool_dtype(df[c]):
@@ -1635,6 +1660,9 @@ class BaseTable(object):
         dtypes = {}        
         #replace default mappings to clobs and booleans
         for c in list(df.columns):
+            if is_categorical_dtype(df[c]):
+                #decode dictionary encoded entity ids
+                df[c] = df[c].astype(object)
             if is_string_dtype(df[c]):
                 dtypes[c] = String(255)
             elif is_bool_dtype(df[c]):
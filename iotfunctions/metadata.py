@@ -15,7 +15,11 @@ import numpy as np
 import json
 import importlib
 import time
-from collections import OrderedDict, defaultdict
+import gzip
+import queue
+import threading
+import atexit
+from collections import OrderedDict, defaultdict, deque
 import pandas as pd
 from pandas.api.types import is_bool, is_number, is_string_dtype, is_timedelta64_dtype
 from sqlalchemy import Table, Column, Integer, SmallInteger, String, DateTime, Float, func
@@ -24,7 +28,7 @@ from ibm_db_sa.base import DOUBLE
 from . import db as db_module
 from .automation import TimeSeriesGenerator, DateGenerator, MetricGenerator, CategoricalGenerator
 from .pipeline import CalcPipeline
-from .util import MemoryOptimizer, StageException
+from .util import MemoryOptimizer, StageException, timed_service_call
 
 logger = logging.getLogger(__name__)
 
@@ -260,12 +264,58 @@ class EntityType(object):
     _output_list = None    
     # processing defaults
     _checkpoint_by_entity = True # manage a separate checkpoint for each entity instance
+    _incremental = False # process only data newer than the checkpoints recorded in the checkpoint table
+    _checkpoint_backtrack = None # pandas timedelta string, e.g. '30min'. Data this much older than the checkpoint is reprocessed
+    _checkpoint_key_col = 'key' # checkpoint table column containing the entity id
+    _checkpoint_timestamp_col = 'timestamp' # checkpoint table column containing the high water mark
     _pre_aggregate_time_grain = None # aggregate incoming data before processing
     _auto_read_from_ts_table = True # read new data from designated time series table for the entity
     _pre_agg_rules = None # pandas agg dictionary containing list of aggregates to apply for each item
     _pre_agg_outputs = None #dictionary containing list of output items names for each item
-    _abort_on_fail = False    
-    
+    _abort_on_fail = False
+    # execute transform stages with no data dependency between them concurrently
+    _parallel_stages = False
+    _max_stage_workers = None # thread pool size. None uses the executor default
+    # split the dataframe by entity and execute entity local stages in a process pool
+    _entity_partitions = None # number of worker processes. None or 1 disables partitioning
+    # streaming execution
+    _stream_window = None # pandas frequency string. Process the time range in windows of this size
+    _stream_entity_batch_size = None # process entities in batches of this size within each window
+    # profiling
+    _profile_stages = False # collect time, rows, columns and service time for each stage
+    _profile_memory = False # include tracemalloc memory deltas in the stage profile
+    # cached namespace of constants available to expressions. Reset by set_params
+    _constants = None
+    # read only the source columns needed by the stages of the pipeline
+    _project_source_items = True
+    # drop columns that are not data items once no later stage needs them
+    _drop_dead_items = True
+    # execute consecutive row-wise stages as a single stage
+    _fuse_stages = True
+    # retrieve data for secondary sources, scd lookups and activity tables concurrently
+    _prefetch_data = True
+    _max_fetch_workers = None # thread pool size. None uses the executor default
+    # capture the dataframe at each stage boundary to this local directory. Replaces to_csv
+    _capture_dir = None
+    _capture_mode = 'delta' # delta captures changed columns only. full captures the whole dataframe
+    _capture_compression = None # None uses snappy for parquet
+    # local directory for the stage result cache. None disables the cache
+    _stage_cache_dir = None
+    _stage_cache_max_size = 1073741824 # bytes
+    # trace entries below this logging level are not recorded
+    _trace_level = logging.INFO
+    _trace_max_entries = 1000 # the trace keeps this many of the most recent entries
+    _trace_persist = False # upload the trace to COS in the background while the pipeline executes
+    # spill cold columns to memory mapped files when the dataframe exceeds this many bytes. None disables spilling
+    _memory_budget = None
+    _spill_dir = None # None uses a directory in the system temp directory
+    # copy the entity id and timestamp index levels into columns of the pipeline dataframe
+    # When False, the columns are added only for the stages that need them
+    _index_columns = True
+    # dictionary encode entity ids as categoricals that share a dictionary per entity type
+    # Ids are decoded when data is written to the database
+    _encode_entity_ids = False
+
     def __init__ (self,name,db, *args, **kwargs):
         self.name = name.lower()
         self.activity_tables = {}
@@ -284,11 +334,14 @@ class EntityType(object):
         self._scd_stages = []
         self._custom_calendar = None
         self._is_initial_transform = True
-        self._trace = Trace(self)
         self._is_preload_complete = False
+        #dictionary of encoded entity ids
+        self._entity_id_dtype = None
+        self._entity_id_lock = threading.Lock()
         
         #additional params set from kwargs
         self.set_params(**kwargs)
+        self._trace = Trace(self)
         self.get_server_params()
         # attach to time series table
         if self._db_schema is None:
@@ -582,6 +635,7 @@ class EntityType(object):
         stages = list(args)
         pl = self.get_calc_pipeline(stages=stages)
         df = pl.execute(to_csv = to_csv, register = register, start_ts = start_ts)
+        pl.commit_checkpoints()
         if publish:
             pl.publish()
         return df
@@ -592,10 +646,23 @@ class EntityType(object):
         '''
         c = {}
         for att in dir(self):
+            if att == '_constants':
+                continue
             value = getattr(self,att)
             if not callable(value):
                 c[att] = value
         return c
+
+    def get_constants(self):
+        '''
+        Get the namespace of constants used by expressions. The namespace is built
+        from get_attributes_dict once and refreshed after set_params changes a parameter.
+        '''
+        if self._constants is None:
+            self._constants = self.get_attributes_dict()
+            msg = 'Built constants namespace for entity type %s with %s entries' %(self.name,len(self._constants))
+            logger.debug(msg)
+        return self._constants
     
     def get_calc_pipeline(self,stages=None):
         '''
@@ -611,9 +678,11 @@ class EntityType(object):
         return self._custom_calendar
         
         
-    def get_data(self,start_ts =None,end_ts=None,entities=None,columns=None):
+    @timed_service_call('db')
+    def get_data(self,start_ts =None,end_ts=None,entities=None,columns=None,drop_all_null_rows=False):
         '''
-        Retrieve entity data at input grain or preaggregated
+        Retrieve entity data at input grain or preaggregated. Set drop_all_null_rows
+        to filter out rows that contain all nulls in the database.
         '''
         
         if entities is None:
@@ -624,8 +693,16 @@ class EntityType(object):
             e_preview = '[%s..]' %entities[0]
         msg = 'Getting entity type data for %s entities %s' %(e_count,e_preview)
         self.trace_append(self,msg)
-        
-        if self._pre_aggregate_time_grain is None:    
+        if columns is not None:
+            columns = self.get_source_columns(columns)
+            msg = 'Retrieving %s source columns required by pipeline stages' %len(columns)
+            self.trace_append(self,msg)
+        
+        if self._pre_aggregate_time_grain is None:
+            not_null_columns = None
+            if drop_all_null_rows:
+                #a row is null when all columns of the source are null, not only the projected ones
+                not_null_columns = self.get_null_filter_columns()
             df = self.db.read_table(
                     table_name = self.name,
                     schema = self._db_schema,
@@ -635,8 +712,9 @@ class EntityType(object):
                     start_ts = start_ts,
                     end_ts = end_ts,
                     entities = entities,
-                    dimension = self._dimension_table_name
-                    ) 
+                    dimension = self._dimension_table_name,
+                    not_null_columns = not_null_columns
+                    )
             self.trace_append(self,'Read source data',df=df)
             
         else:
@@ -729,6 +807,77 @@ class EntityType(object):
             
         return items.intersection(candidate_items)
     
+    def get_source_items(self,stages):
+        '''
+        Get the set of items that must be retrieved from the source table to
+        execute a list of stages. Returns None when all items must be retrieved.
+        '''
+        if not self._project_source_items:
+            return None
+        items = set()
+        for s in stages:
+            name = getattr(s,'name',s.__class__.__name__)
+            if getattr(s,'requires_all_source_items',False):
+                msg = 'Stage %s requires all source items. Source columns will not be projected' %name
+                logger.debug(msg)
+                return None
+            if getattr(s,'_input_set',None) is None:
+                msg = 'Stage %s has no input set. Source columns will not be projected' %name
+                logger.debug(msg)
+                return None
+            items |= set(s._input_set)
+            #stages executed by a key group on the key columns
+            items |= set(getattr(s,'execute_by',None) or [])
+            for method in ['get_input_items','get_source_items']:
+                try:
+                    items |= set(getattr(s,method)())
+                except AttributeError:
+                    pass
+        return items
+    
+    def get_pipeline_source_items(self,stages):
+        '''
+        Get the set of items that must be retrieved from the source table to
+        execute a pipeline. When stages were built from the server metadata, the
+        stages of all granularities are included so that aggregation stages that
+        execute after the pipeline have their inputs.
+        '''
+        all_stages = list(stages)
+        if self._stages:
+            ids = set([id(s) for s in all_stages])
+            for level_stages in list(self._stages.values()):
+                all_stages.extend([s for s in level_stages if id(s) not in ids])
+        return self.get_source_items(all_stages)
+    
+    def get_source_columns(self,items):
+        '''
+        Get the list of columns of the source table and dimension to retrieve for
+        a set of items. System columns are always retrieved.
+        '''
+        available = self.db.get_column_names(self.name,self._db_schema)
+        if self._dimension_table_name is not None:
+            dim_cols = self.db.get_column_names(self._dimension_table_name,self._db_schema)
+            available.extend([x for x in dim_cols if x not in available])
+        required = set(items) | set(self._system_columns)
+        columns = [x for x in available if x in required]
+        msg = 'Projected %s of %s source columns' %(len(columns),len(available))
+        logger.debug(msg)
+        return columns
+    
+    def get_null_filter_columns(self,columns=None):
+        '''
+        Get the source columns that are considered when dropping rows that contain
+        all nulls. Uses all columns of the source table and dimension when no
+        columns are supplied.
+        '''
+        if columns is None:
+            columns = self.db.get_column_names(self.name,self._db_schema)
+            if self._dimension_table_name is not None:
+                dim_cols = self.db.get_column_names(self._dimension_table_name,self._db_schema)
+                columns.extend([x for x in dim_cols if x not in columns])
+        exclude = set(self._system_columns) | set(self._custom_exclude_col_from_auto_drop_nulls)
+        return [x for x in columns if x not in exclude]
+    
     def get_stage_output_item_list(self,arg_meta):
         
         items = []
@@ -980,6 +1129,39 @@ class EntityType(object):
         return self._entity_filter_list
         
     
+    def get_entity_ids(self,start_ts=None,end_ts=None):
+        '''
+        Get the list of distinct entity ids with data in the time series table
+        '''
+        (query,table) = self.db.query(self.name,
+                                      schema = self._db_schema,
+                                      column_names = [self._entity_id],
+                                      timestamp_col = self._timestamp,
+                                      start_ts = start_ts,
+                                      end_ts = end_ts)
+        return [x[0] for x in query.distinct()]
+
+    def get_dimension_entity_ids(self):
+        '''
+        Get the list of entity ids in the dimension table. Returns None when
+        the entity type has no dimension table.
+        '''
+        if self._dimension_table_name is None:
+            return None
+        df = self.db.read_table(self._dimension_table_name, schema = self._db_schema, columns = [self._entity_id])
+        return [x for x in df[self._entity_id].unique() if x is not None]
+
+    def get_first_timestamp(self):
+        '''
+        Get the earliest timestamp in the time series table
+        '''
+        (query,table) = self.db.query_column_aggregate(
+                                table_name = self.name,
+                                schema = self._db_schema,
+                                column = self._timestamp,
+                                aggregate = 'min')
+        return query.scalar()
+
     def get_last_checkpoint(self):
         '''
         Get the last checkpoint recorded for entity type
@@ -988,11 +1170,61 @@ class EntityType(object):
         (query,table) = self.db.query_column_aggregate(
                                 table_name = self.checkpoint_table,
                                 schema = self._db_schema,
-                                column = 'TIMESTAMP',
+                                column = self._checkpoint_timestamp_col,
                                 aggregate = 'max')
         
-        query.filter(table.c.entity_type_id==self._entity_type_id)                
+        query = query.filter(table.c.entity_type_id==self._entity_type_id)
         return query.scalar()
+
+    def get_checkpoints(self):
+        '''
+        Get a dict containing the high water mark timestamp of each entity
+        from the checkpoint table. When checkpoints are not managed by entity
+        the dict contains a single checkpoint keyed on None.
+        '''
+        if not self._checkpoint_by_entity:
+            last = self.get_last_checkpoint()
+            if last is None:
+                return {}
+            return {None : last}
+        (query,table) = self.db.query(self.checkpoint_table,
+                                      schema = self._db_schema,
+                                      column_names = [self._checkpoint_key_col,
+                                                      self._checkpoint_timestamp_col])
+        query = query.filter(table.c.entity_type_id==self._entity_type_id)
+        checkpoints = {}
+        for (key,timestamp) in query:
+            if timestamp is not None:
+                checkpoints[key] = timestamp
+        msg = 'Retrieved %s checkpoints for entity type %s' %(len(checkpoints),self.name)
+        logger.debug(msg)
+        return checkpoints
+
+    def write_checkpoints(self,checkpoints):
+        '''
+        Replace the checkpoints of the entities in a dict of high water marks
+        keyed on entity id. The checkpoint of an entity type that does not manage
+        checkpoints by entity is keyed on None. Checkpoints are deleted and inserted
+        in a single transaction.
+        '''
+        if len(checkpoints) == 0:
+            return
+        table = self.db.get_table(self.checkpoint_table,self._db_schema)
+        key_col = table.c[self._checkpoint_key_col]
+        is_entity_type = table.c.entity_type_id==self._entity_type_id
+        keys = [x for x in list(checkpoints.keys()) if x is not None]
+        rows = [{'entity_type_id' : self._entity_type_id,
+                 self._checkpoint_key_col : key,
+                 self._checkpoint_timestamp_col : value} for (key,value) in list(checkpoints.items())]
+        with self.db.connection.begin() as connection:
+            if None in checkpoints:
+                connection.execute(table.delete().where(is_entity_type & key_col.is_(None)))
+            for i in range(0,len(keys),self.db.write_chunk_size):
+                chunk = keys[i:i+self.db.write_chunk_size]
+                connection.execute(table.delete().where(is_entity_type & key_col.in_(chunk)))
+            connection.execute(table.insert(),rows)
+        msg = 'Wrote %s checkpoints for entity type %s' %(len(rows),self.name)
+        logger.debug(msg)
                 
     
     def generate_scd_data(self,scd_obj,entities,days,seconds,write=True):
@@ -1075,7 +1307,16 @@ class EntityType(object):
             logger.debug(('Found existing index on %s, %s.'
                           'No need to recreate index'),self._df_index_entity_id,
                          self._timestamp)
+
+        if self._encode_entity_ids:
+            df = self.encode_df_entity_ids(df)
                 
+        if not self._index_columns:
+            #the index levels are the only copy of the entity id and timestamp
+            if self._entity_id != self._df_index_entity_id and self._entity_id in df.columns:
+                del df[self._entity_id]
+            return df
+
         #create a dummy column for _entity_id
         if self._entity_id != self._df_index_entity_id:
             df[self._entity_id] = df.index.get_level_values(self._df_index_entity_id)
@@ -1088,6 +1329,77 @@ class EntityType(object):
         
         return df    
 
+    def get_entity_id_dtype(self,values = None):
+        '''
+        Get the categorical dtype used to encode entity ids. The categories of
+        the dtype are the dictionary of the entity type. Values that are not in
+        the dictionary are appended so that existing codes do not change.
+        '''
+        with self._entity_id_lock:
+            if self._entity_id_dtype is None:
+                categories = pd.Index([],dtype=object)
+            else:
+                categories = self._entity_id_dtype.categories
+            new_values = []
+            if values is not None:
+                new_values = pd.Index(values).dropna().difference(categories)
+            if self._entity_id_dtype is None or len(new_values) > 0:
+                self._entity_id_dtype = pd.api.types.CategoricalDtype(categories = categories.append(new_values))
+                msg = 'Added %s entity ids to the entity id dictionary' %len(new_values)
+                logger.debug(msg)
+            return self._entity_id_dtype
+
+    def encode_entity_ids(self,values):
+        '''
+        Encode entity ids as a categorical using the dictionary of the entity
+        type. Ids are converted to strings. Only the unique ids are converted.
+        '''
+        if self._entity_id_dtype is not None and getattr(values,'dtype',None) == self._entity_id_dtype:
+            return values
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(uniques).astype(str)
+        dtype = self.get_entity_id_dtype(uniques)
+        #missing ids have a code of -1 and remain missing
+        lookup = np.append(dtype.categories.get_indexer(uniques),-1)
+        return pd.Categorical.from_codes(lookup[codes], dtype = dtype)
+
+    def encode_df_entity_ids(self,df):
+        '''
+        Encode the entity id index level and entity id column of a dataframe
+        '''
+        if self._df_index_entity_id in df.index.names:
+            if isinstance(df.index,pd.MultiIndex):
+                #only the unique values of the level need to be encoded
+                level = df.index.names.index(self._df_index_entity_id)
+                values = self.encode_entity_ids(df.index.levels[level])
+                df.index = df.index.set_levels(pd.CategoricalIndex(values),level = level)
+            else:
+                df.index = pd.CategoricalIndex(self.encode_entity_ids(df.index),name = df.index.name)
+        if self._entity_id in df.columns:
+            df[self._entity_id] = self.encode_entity_ids(df[self._entity_id])
+        return df
+
+    def add_index_columns(self,df):
+        '''
+        Copy the entity id and timestamp index levels of an indexed dataframe into
+        columns. Use when the _index_columns param is False and a function needs
+        the columns. Returns a list of the columns added.
+        '''
+        added = []
+        levels = [(self._entity_id,self._df_index_entity_id),
+                  (self._timestamp_col,self._timestamp)]
+        for (col,level) in levels:
+            if col == level or col in df.columns:
+                continue
+            try:
+                df[col] = df.index.get_level_values(level)
+            except KeyError:
+                msg = 'Unable to add column %s. Dataframe has no index level %s' %(col,level)
+                logger.debug(msg)
+            else:
+                added.append(col)
+        return added
+
     def is_base_item(self,item_name):
         '''
         Base items are non calculated data items.
@@ -1191,7 +1503,7 @@ class EntityType(object):
         '''
         Raise an exception. Append a message and the current trace to the stacktrace.
         '''
-        msg = msg + ' Trace follows: ' + str(self._trace)
+        msg = msg + ' Trace follows: ' + self._trace.get_text(last = self._trace.error_entries)
          
         msg = 'Execution of stage %s failed because of %s: %s - %s ' %(stageName,type(exception).__name__,str(exception),msg)
         if abort_on_fail:
@@ -1290,13 +1602,41 @@ class EntityType(object):
         '''
         Clear trace information
         '''
-        self._trace.data = []
+        self._trace.reset()
         
-    def trace_save(self,execute_date):
+    def trace_persist(self,execute_date):
         '''
-        Write trace to COS
+        Start uploading the trace to COS in the background. Entries already in
+        the trace are uploaded first. Returns the prefix of the trace files.
         '''
+        if self._trace.writer is not None:
+            return self._trace.writer.prefix
+        prefix = '%s_trace_%s' %(self.name, execute_date)
+        writer = TraceWriter(trace = self._trace, db = self.db, prefix = prefix)
+        for entry in list(self._trace.data):
+            writer.write(entry)
+        self._trace.writer = writer
+        return prefix
         
+    def trace_flush(self):
+        '''
+        Wait for the trace entries written so far to be uploaded
+        '''
+        if self._trace.writer is not None:
+            self._trace.writer.flush()
+        
+    def trace_save(self,execute_date):
+        '''
+        Write trace to COS. When the trace is being uploaded in the background,
+        upload the remaining entries, wait for the upload to complete and return
+        the name of a json manifest that lists the trace files. Otherwise the
+        trace is written as a single json object and its name is returned.
+        '''
+        if self._trace.writer is not None:
+            trace_filename = self._trace.writer.prefix
+            self._trace.writer.close()
+            self._trace.writer = None
+            return trace_filename
         trace = self._trace.as_json()
         trace_filename = '%s_trace_%s' %(self.name, execute_date)
         self.db.cos_save(persisted_object=trace,filename=trace_filename,binary=True)
@@ -1363,8 +1703,10 @@ class EntityType(object):
         '''
         for key,value in list(params.items()):
             setattr(self, key, value)
+        self._constants = None
         return self
     
+    @timed_service_call('db')
     def write_unmatched_members(self,df):
         '''
         Write a row to the dimension table for every entity instance in the dataframe supplied
@@ -1382,7 +1724,10 @@ class EntityType(object):
             ef = self.db.read_table(self._dimension_table_name, schema = self._db_schema, columns = [self._entity_id])
             ids = set(ef[self._entity_id].unique())
             #get new members from the dataframe supplied
-            new_ids = set(df[self._entity_id].unique()) - ids
+            try:
+                new_ids = set(df[self._entity_id].unique()) - ids
+            except KeyError:
+                new_ids = set(df.index.get_level_values(self._df_index_entity_id).unique()) - ids
             #write
             self.db.start_session()
             table = self.db.get_table(self._dimension_table_name, self._db_schema)
@@ -1443,99 +1788,324 @@ class Granularity(object):
 
 class Trace(object)    :
     '''
-    Gather status and diagnostic information to report back in the UI
+    Gather status and diagnostic information to report back in the UI.
+    
+    Entries are held in a ring buffer of max_entries. Entries below the trace
+    level are not recorded. Messages are formatted with their args when the
+    trace is rendered. The columns, index names and row count of a dataframe
+    are kept when the entry is written and compared with those of the previous
+    dataframe when the trace is rendered. Other entry values that are not
+    scalars are converted to strings when they are written. The level and
+    buffer size are taken from the _trace_level and _trace_max_entries params
+    of the parent.
     '''
     elapsed_threshold_sec = 2 #threshold for wring elapsed time to the trace
     primary_df = 'df'
+    level = logging.INFO
+    max_entries = 1000
+    error_entries = 50 #number of recent entries included in error messages
+    writer = None #TraceWriter that persists entries as they are written
     def __init__(self,parent=None):
         if parent is None:
             parent = self
         self.parent = parent
-        self.data = []
-        self.df_cols = set()
-        self.df_index = set()
-        self.df_count = 0
-        self.prev_ts = dt.datetime.utcnow()
+        self._lock = threading.Lock() #stages executing concurrently write to the same trace
+        self.reset()
         self.write(created_by=parent,text='Trace started. ')
         
-    def write(self,created_by,text,log_method=None,**kwargs):
-        ts = dt.datetime.utcnow()
-        text = str(text)
-        try:
-            (kwargs[self.primary_df],msg) = self._df_as_dict(kwargs[self.primary_df],prefix=self.primary_df)
-        except (KeyError,AttributeError):
-            msg = ''   
-        text = text + msg
-        elapsed = (ts - self.prev_ts).total_seconds()
-        self.prev_ts = ts
-        if elapsed >= self.elapsed_threshold_sec:
-            msg = 'Time since last trace entry: %s sec. ' %elapsed
-            text = text + msg
-        entry = { 'timestamp' : str(ts),
-          'created_by' : str(created_by),
-          'text': text,
-          'elapsed_time' : elapsed
-        }
-        for key,value in list(kwargs.items()):            
-            if not isinstance(value,str):
-                kwargs[key] = str(value)
-        entry = {**entry,**kwargs}
-        self.data.append(entry)
+    def reset(self):
+        '''
+        Clear the trace
+        '''
+        max_entries = getattr(self.parent,'_trace_max_entries',self.max_entries)
+        self.data = deque(maxlen = max_entries)
+        self._df_state = None
+        self.prev_ts = dt.datetime.utcnow()
+        
+    def get_level(self):
+        
+        return getattr(self.parent,'_trace_level',self.level)
+    
+    def is_enabled_for(self,level):
+        
+        return level >= self.get_level()
+        
+    def write(self,created_by,text,log_method=None,level=None,args=None,**kwargs):
+        if level is None:
+            level = logging.INFO
+        if not self.is_enabled_for(level):
+            if log_method is not None:
+                log_method(self._format_text(text,args))
+            return
+        with self._lock:
+            ts = dt.datetime.utcnow()
+            df_state = None
+            df = kwargs.pop(self.primary_df,None)
+            if df is not None:
+                #index objects are immutable. They are compared when the trace is rendered
+                try:
+                    state = (len(df.index),df.columns,df.index.names)
+                except AttributeError:
+                    pass
+                else:
+                    df_state = (self._df_state,state)
+                    self._df_state = state
+            elapsed = (ts - self.prev_ts).total_seconds()
+            self.prev_ts = ts
+            kwargs = {key : self._snapshot_value(value) for (key,value) in list(kwargs.items())}
+            entry = { 'timestamp' : ts,
+              'created_by' : str(created_by),
+              'text': text,
+              'args' : args,
+              'df' : df_state,
+              'elapsed_time' : elapsed,
+              'level' : level,
+              'kwargs' : kwargs
+            }
+            self.data.append(entry)
+            if self.writer is not None:
+                self.writer.write(entry)
          
         try:
             if log_method is not None:
-                log_method(text)
+                log_method(self._get_entry_text(entry))
         except TypeError:
-            msg = 'A write to the trace called an invalid logging method. Logging as warning: %s' %text
+            msg = 'A write to the trace called an invalid logging method. Logging as warning: %s' %self._get_entry_text(entry)
             logger.warning(msg)
             
-    def _df_as_dict(self,df,prefix):
+    def detach(self):
+        '''
+        Prepare the trace for use in a process forked from the process that
+        created it. The worker does not upload entries. They are returned to
+        the parent using get_portable_entries and extend.
+        '''
+        self._lock = threading.Lock()
+        self.writer = None
+        self.data = deque(maxlen = self.data.maxlen)
+
+    def get_portable_entries(self):
+        '''
+        Get a list of trace entries that can be pickled. Objects that created
+        entries and non scalar values are converted to strings.
+        '''
+        entries = []
+        for entry in list(self.data):
+            entry = dict(entry)
+            entry['text'] = self._format_text(entry['text'],entry['args'])
+            entry['args'] = None
+            entries.append(entry)
+        return entries
+
+    def extend(self,entries):
+        '''
+        Add entries written by another process
+        '''
+        with self._lock:
+            for entry in entries:
+                self.data.append(entry)
+                if self.writer is not None:
+                    self.writer.write(entry)
+
+    def _snapshot_value(self,value):
+        
+        if isinstance(value,(str,int,float,bool,type(None))):
+            return value
+        return str(value)
+
+    def _format_text(self,text,args):
+        
+        text = str(text)
+        if args:
+            try:
+                text = text %args
+            except (TypeError,ValueError):
+                text = '%s %s' %(text,args)
+        return text
+            
+    def _get_entry_text(self,entry):
+        
+        text = self._format_text(entry['text'],entry['args']) + self._get_df_text(entry)
+        if entry['elapsed_time'] >= self.elapsed_threshold_sec:
+            msg = 'Time since last trace entry: %s sec. ' %entry['elapsed_time']
+            text = text + msg
+        return text
+    
+    def _render_entry(self,entry):
+        
+        rendered = { 'timestamp' : str(entry['timestamp']),
+          'created_by' : str(entry['created_by']),
+          'text': self._get_entry_text(entry),
+          'elapsed_time' : entry['elapsed_time'],
+          'level' : logging.getLevelName(entry['level'])
+        }
+        if entry['df'] is not None:
+            rendered[self.primary_df] = str(self._get_df_dict(entry,prefix=self.primary_df))
+        for key,value in list(entry['kwargs'].items()):            
+            if not isinstance(value,str):
+                value = str(value)
+            rendered[key] = value
+        return rendered
+            
+    def _get_df_text(self,entry):
+        
+        if entry['df'] is None:
+            return ''
+        (prev,state) = entry['df']
+        if prev is None:
+            prev = (0,[],[])
+        (prev_count,prev_cols,prev_index) = prev
+        (count,cols,index) = state
         msg = ''
-        data = {}
-        prev_count = self.df_count
-        prev_index = self.df_index
-        prev_cols = self.df_cols
-        self.df_count = len(df.index)
-        if df.index.names is None:
-            self.df_index = {}
-        else:
-            self.df_index = set(df.index.names)
-        self.df_cols = set(df.columns)
-        #formulate message based on changes
-        if self.df_count > prev_count:
-            msg = '%s Added %s rows. ' %(msg,self.df_count - prev_count)
-        if self.df_count < prev_count:
-            msg = '%s Removed %s rows. ' %(msg,self.df_count - prev_count)            
-        if len(self.df_index-prev_index)>0:
-            msg = '%s Added to index %s. ' %(msg,self.df_index-prev_index)
-        if len(prev_index-self.df_index)>0:
-            msg = '%s Removed from index %s ' %(msg,prev_index-self.df_index)
-        if len(self.df_cols-prev_cols)>0:
-            msg = '%s Added columns %s. ' %(msg,self.df_cols-prev_cols)
-        if len(prev_cols-self.df_cols)>0:
-            msg = '%s Removed columns %s.  ' %(msg,prev_cols-self.df_cols)            
-        #also include a dict with actual stats
-        data['%s_count' %prefix] = self.df_count
-        data['%s_index' %prefix] = self.df_index
-        data['%s_columns' %prefix] = self.df_cols
-    
-        return(data,msg)
+        if count > prev_count:
+            msg = '%s Added %s rows. ' %(msg,count - prev_count)
+        if count < prev_count:
+            msg = '%s Removed %s rows. ' %(msg,count - prev_count)
+        if index is not prev_index:
+            (added,removed) = self._get_changes(prev_index,index)
+            if len(added)>0:
+                msg = '%s Added to index %s. ' %(msg,added)
+            if len(removed)>0:
+                msg = '%s Removed from index %s ' %(msg,removed)
+        if cols is not prev_cols:
+            (added,removed) = self._get_changes(prev_cols,cols)
+            if len(added)>0:
+                msg = '%s Added columns %s. ' %(msg,added)
+            if len(removed)>0:
+                msg = '%s Removed columns %s.  ' %(msg,removed)
+        return msg
+    
+    def _get_changes(self,prev,current):
+        
+        prev = set([x for x in prev if x is not None])
+        current = set([x for x in current if x is not None])
+        return (current - prev, prev - current)
+    
+    def _get_df_dict(self,entry,prefix):
+        
+        (count,cols,index) = entry['df'][1]
+        return {'%s_count' %prefix : count,
+                '%s_index' %prefix : set([x for x in index if x is not None]),
+                '%s_columns' %prefix : set(cols)}
+    
+    def get_text(self,last=None):
+        '''
+        Get the text of the trace. Set last to limit the text to the most recent entries.
+        '''
+        entries = list(self.data)
+        if last is not None:
+            entries = entries[-last:]
+        return ''.join([self._get_entry_text(x) for x in entries])
         
     def as_json(self):
         
-        return json.dumps(self.data)
+        return json.dumps([self._render_entry(x) for x in self.data])
     
     def __str__(self):
         
-        out = ''
-        for entry in self.data:
-            out = out + entry['text'] 
-            
-        return out
+        return self.get_text()
                 
     
 
 
+class TraceWriter(object):
+    '''
+    Upload trace entries to COS as gzip compressed newline delimited json.
+    Entries are rendered, compressed and uploaded by a background thread in
+    parts of part_entries entries, or after flush_interval seconds, so that
+    uploads overlap with pipeline execution and the trace of a failed run is
+    retained up to the last part. Each part is a complete gzip file named
+    <prefix>_<part number>.ndjson.gz. Concatenated parts are also a valid gzip stream.
+    Remaining entries are uploaded when the writer is closed or the interpreter exits.
+    Closing the writer also saves a json manifest named <prefix> that lists the parts.
+    '''
+    part_entries = 500
+    flush_interval = 30 #seconds
+    
+    def __init__(self, trace, db, prefix, bucket = None):
+        self.trace = trace
+        self.db = db
+        self.prefix = prefix
+        self.bucket = bucket
+        self.parts = []
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target = self._write, name = 'trace_writer', daemon = True)
+        self._writer.start()
+        atexit.register(self.close)
+        
+    def write(self,entry):
+        '''
+        Queue a trace entry for upload
+        '''
+        self._queue.put(entry)
+        
+    def flush(self):
+        '''
+        Upload the queued entries and wait for the upload to complete
+        '''
+        if self._writer.is_alive():
+            self._queue.put(False)
+            self._queue.join()
+        
+    def close(self):
+        '''
+        Upload the remaining entries and wait for the background thread to finish
+        '''
+        atexit.unregister(self.close)
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+            self._save_manifest()
+            
+    def _save_manifest(self):
+        manifest = json.dumps({'format' : 'ndjson.gz', 'parts' : self.parts})
+        try:
+            self.db.cos_save(persisted_object = manifest, filename = self.prefix, bucket = self.bucket,
+                             binary = True)
+        except Exception as e:
+            msg = 'Unable to save trace manifest %s. %s' %(self.prefix,e)
+            logger.warning(msg)
+        
+    def _write(self):
+        lines = []
+        while True:
+            try:
+                entry = self._queue.get(timeout = self.flush_interval)
+            except queue.Empty:
+                entry = False
+                is_queued = False
+            else:
+                is_queued = True
+            try:
+                if entry:
+                    try:
+                        lines.append(json.dumps(self.trace._render_entry(entry)))
+                    except (TypeError,ValueError) as e:
+                        msg = 'Unable to render trace entry. %s' %e
+                        logger.warning(msg)
+                if len(lines) > 0 and (len(lines) >= self.part_entries or not entry):
+                    self._upload(lines)
+                    lines = []
+            finally:
+                if is_queued:
+                    self._queue.task_done()
+            if entry is None:
+                break
+            
+    def _upload(self,lines):
+        filename = '%s_%05d.ndjson.gz' %(self.prefix,len(self.parts))
+        payload = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+        try:
+            self.db.cos_save(persisted_object = payload, filename = filename, bucket = self.bucket,
+                             binary = True, serialize = False)
+        except Exception as e:
+            msg = 'Unable to upload trace part %s. %s' %(filename,e)
+            logger.warning(msg)
+        else:
+            msg = 'Uploaded %s trace entries to %s' %(len(lines),filename)
+            logger.debug(msg)
+        self.parts.append(filename)
+
+
 class Model(object):
     '''
     Predictive model
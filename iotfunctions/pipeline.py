@@ -9,16 +9,75 @@
 # *****************************************************************************
 
 import logging
+import datetime as dt
 import json
 import re
+import inspect
 import numpy as np
 import sys
-from .util import log_df_info
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .util import log_df_info, StageProfiler, StageCache, StageCapture, ColumnSpiller, compile_expression
 import pandas as pd
-from pandas.api.types import is_bool_dtype, is_numeric_dtype, is_string_dtype, is_datetime64_any_dtype
+from pandas.api.types import is_bool_dtype, is_numeric_dtype, is_string_dtype, is_datetime64_any_dtype, is_categorical_dtype
 
 logger = logging.getLogger(__name__)
 
+# pipeline, stages, shards and execution args shared with forked partition workers
+_partition_context = None
+
+
+def _init_partition_worker():
+    '''
+    Prepare a worker process forked from the pipeline. Connections, threads
+    and locks inherited from the pipeline process are not used by the worker.
+    '''
+    (pipeline,stages,shards,kwargs) = _partition_context
+    # the capture writer thread does not exist in the forked worker
+    pipeline._capture = None
+    pipeline._lock = threading.Lock()
+    # pooled connections belong to the pipeline process
+    try:
+        engine = pipeline.entity_type.db.connection
+    except AttributeError:
+        engine = None
+    if engine is not None:
+        try:
+            engine.dispose(close = False)
+        except TypeError:
+            engine.dispose()
+        except AttributeError:
+            pass
+    try:
+        pipeline.entity_type._trace.detach()
+    except AttributeError:
+        pass
+
+
+def _execute_partition(partition):
+    '''
+    Execute transform stages against a single entity partition.
+    Runs in a worker process forked from the pipeline. Returns the dataframe
+    with the trace entries and profile records written by the worker.
+    '''
+    (pipeline,stages,shards,kwargs) = _partition_context
+    trace = getattr(pipeline.entity_type,'_trace',None)
+    if trace is not None:
+        trace.data.clear()
+    if pipeline._profiler is not None:
+        pipeline._profiler.data = []
+    df = pipeline._execute_transform_stages(stages = stages, df = shards[partition], **kwargs)
+    entries = []
+    if trace is not None:
+        entries = trace.get_portable_entries()
+    profile = []
+    if pipeline._profiler is not None:
+        profile = pipeline._profiler.data
+        for record in profile:
+            record['partition'] = partition
+    return (df,entries,profile)
+
 
 class CalcPipeline:
     '''
@@ -27,6 +86,18 @@ class CalcPipeline:
     def __init__(self,stages = None,entity_type =None):
         self.logger = logging.getLogger('%s.%s' % (self.__module__, self.__class__.__name__))
         self.entity_type = entity_type
+        self._profiler = None
+        self._stage_cache = None
+        self._capture = None
+        self._live_items = None
+        self._schema = None
+        self._is_executing_level = False
+        self._stage_plans = {}
+        self._conformed_index = None
+        self._index_producer = None
+        self._index_rebuilds = []
+        self._lock = threading.Lock() #guards pipeline state written by concurrent stages
+        self._pending_checkpoints = None #checkpoints of the last execution. Written by commit_checkpoints
         self.set_stages(stages)
         self.log_pipeline_stages()
         
@@ -43,7 +114,9 @@ class CalcPipeline:
         Add a new stage to a pipeline. A stage is Transformer or Aggregator.
         '''
         stage.set_entity_type(self.entity_type)
+        stage._is_pipeline_stage = True
         self.stages.append(stage)
+        self._stage_plans[id(stage)] = StagePlan(stage,index_columns = self._get_index_columns())
           
         
     def _extract_preload_stages(self):
@@ -57,12 +130,8 @@ class CalcPipeline:
         stages = []
         extracted_stages = []
         for s in self.stages:
-            try:
-                is_preload = s.is_preload
-            except AttributeError:
-                is_preload = False
             #extract preload stages
-            if is_preload:
+            if self._get_stage_plan(s).is_preload:
                 msg = 'Extracted preload stage %s from pipeline' %s.__class__.__name__
                 logger.debug(msg)
                 extracted_stages.append(s)
@@ -79,27 +148,62 @@ class CalcPipeline:
         '''
         (preload_stages,stages) = self._extract_preload_stages()
         preload_item_names = []
-        #if no dataframe provided, querying the source entity to get one
+        if self.entity_type._is_preload_complete:
+            #preload stages executed in an earlier window. Their items are still
+            #added so that every window has the same output columns
+            for p in preload_stages:
+                try:
+                    preload_item_names.append(p.output_item)
+                except AttributeError:
+                    pass
+            return(stages,preload_item_names)
+        #consecutive independent preload stages execute concurrently
+        groups = []
         for p in preload_stages:
-            if not self.entity_type._is_preload_complete:
-                msg = 'Stage %s :' %p.__class__.__name__
-                status = p.execute(df=None,start_ts=start_ts,end_ts=end_ts,entities=entities)
-                msg = '%s completed as pre-load. ' %p.__class__.__name__
+            if (len(groups) > 0 and self._is_independent_preload(p) and
+                    self._is_independent_preload(groups[-1][-1])):
+                groups[-1].append(p)
+            else:
+                groups.append([p])
+        kwargs = {'start_ts' : start_ts, 'end_ts' : end_ts, 'entities' : entities, 'register' : register}
+        for group in groups:
+            if len(group) == 1:
+                statuses = [self._execute_preload_stage(group[0],**kwargs)]
+            else:
+                msg = 'Executing independent preload stages %s concurrently. ' %[p.__class__.__name__ for p in group]
                 self.trace_append(msg)
-                if register:
-                    p.register(df=None)
+                with ThreadPoolExecutor(max_workers = self.entity_type.get_param('_max_stage_workers')) as executor:
+                    futures = [executor.submit(self._execute_preload_stage,p,**kwargs) for p in group]
+                    statuses = [f.result() for f in futures]
+            for (p,status) in zip(group,statuses):
                 try:
                     preload_item_names.append(p.output_item)
                 except AttributeError:
                     msg = 'Preload functions are expected to have an argument and property called output_item. This preload function is not defined correctly'
                     raise AttributeError (msg)
-                if not status:
-                    msg = 'Preload stage %s returned with status of False. Aborting execution. ' %p.__class__.__name__
-                    self.trace_append(msg)
-                    stages = []
-                    break
+            aborted = [p for (p,status) in zip(group,statuses) if not status]
+            if len(aborted) > 0:
+                msg = 'Preload stage %s returned with status of False. Aborting execution. ' %aborted[0].__class__.__name__
+                self.trace_append(msg)
+                stages = []
+                break
         self.entity_type._is_preload_complete = True
         return(stages,preload_item_names)
+
+    def _is_independent_preload(self,stage):
+        
+        return self._get_stage_plan(stage).is_independent
+
+    def _execute_preload_stage(self,p,start_ts,end_ts,entities,register):
+        '''
+        Execute a single preload stage and return its status
+        '''
+        status = p.execute(df=None,start_ts=start_ts,end_ts=end_ts,entities=entities)
+        msg = '%s completed as pre-load. ' %p.__class__.__name__
+        self.trace_append(msg)
+        if register:
+            p.register(df=None)
+        return status
     
     
     def _execute_data_sources(self,stages,
@@ -119,25 +223,14 @@ class CalcPipeline:
         special_lookup_stages = []
         replace_count = 0
         for s in stages:
-            try:
-                is_data_source =  s.is_data_source
-                merge_method = s.merge_method
-            except AttributeError:
-                is_data_source = False
-                merge_method = None        
-                
-            try:
-                is_scd_lookup = s.is_scd_lookup
-            except AttributeError:
-                is_scd_lookup = False
-            else:
+            plan = self._get_stage_plan(s)
+            is_data_source = plan.is_data_source
+            merge_method = plan.merge_method
+            is_scd_lookup = plan.is_scd_lookup
+            is_custom_calendar = plan.is_custom_calendar
+            if plan.has_scd_lookup:
                 self.entity_type._add_scd_pipeline_stage(s)
-
-            try:
-                is_custom_calendar = s.is_custom_calendar
-            except AttributeError:
-                is_custom_calendar = False
-            else:
+            if plan.has_custom_calendar:
                 self.entity_type.set_custom_calendar(s)
                   
             if is_data_source and merge_method == 'replace':
@@ -166,6 +259,9 @@ class CalcPipeline:
         if replace_count > 1:
             self.logger.warning("The pipeline has more than one custom source with a merge strategy of replace. The pipeline will only contain data from the last replacement")        
         
+        #retrieve data for secondary data sources concurrently
+        scope = (start_ts,end_ts,entities)
+        self._prefetch_data(secondary_sources,df,scope)
         #execute secondary data sources
         if len(secondary_sources) > 0:
             for s in secondary_sources:
@@ -183,6 +279,7 @@ class CalcPipeline:
         
         #exceute special lookup stages
         if not df.empty and len(special_lookup_stages) > 0:                
+            self._prefetch_data(special_lookup_stages,df,scope)
             for s in special_lookup_stages:
                 msg = 'Processing special lookup stage %s. ' %s.__class__.__name__
                 self.trace_append(msg)
@@ -199,28 +296,110 @@ class CalcPipeline:
         return(df,remaining_stages)    
             
                 
+    def _prefetch_data(self,stages,df,scope=None):
+        '''
+        Execute the data retrieval tasks of a list of stages concurrently. The
+        result is made available to each stage through pop_prefetched_data().
+        The data is tied to the scope (start_ts, end_ts, entities) of the execution.
+        '''
+        if not self.entity_type.get_param('_prefetch_data'):
+            return
+        tasks = []
+        for s in stages:
+            try:
+                task = s.get_prefetch_task(df)
+            except (AttributeError,KeyError):
+                continue
+            if task is not None:
+                tasks.append((s,task))
+        if len(tasks) < 2:
+            return
+        msg = 'Retrieving data for stages %s concurrently. ' %[s.__class__.__name__ for (s,task) in tasks]
+        self.trace_append(msg)
+        with ThreadPoolExecutor(max_workers = self.entity_type.get_param('_max_fetch_workers')) as executor:
+            futures = [(s,executor.submit(task)) for (s,task) in tasks]
+            for (s,f) in futures:
+                try:
+                    s._prefetched_data = f.result()
+                except Exception as e:
+                    msg = 'Unable to prefetch data for stage %s. Data will be retrieved when the stage executes. %s' %(s.__class__.__name__,e)
+                    logger.warning(msg)
+                    s._prefetched_data = None
+                s._prefetched_scope = scope
+
+    def _release_prefetched_data(self,stages,scope=None):
+        '''
+        Discard data prefetched for stages. When a scope is supplied, data that
+        was retrieved for the same scope is retained.
+        '''
+        for s in stages:
+            if getattr(s,'_prefetched_data',None) is None:
+                continue
+            try:
+                if scope is not None and bool(getattr(s,'_prefetched_scope',None) == scope):
+                    continue
+            except ValueError:
+                # entities that cannot be compared are treated as a different scope
+                pass
+            s._prefetched_data = None
+            s._prefetched_scope = None
+        
     def execute(self, df=None, to_csv=False, dropna=False, start_ts = None, end_ts = None, entities = None, preloaded_item_names=None,
-                register = False):
+                register = False, ts_override = True):
+        '''
+        Execute the pipeline using an input dataframe as source.
+        Set ts_override to False when the caller has already applied the start and
+        end timestamp overrides of the entity type.
+        '''
+        try:
+            return self._execute(df = df, to_csv = to_csv, dropna = dropna, start_ts = start_ts,
+                                 end_ts = end_ts, entities = entities,
+                                 preloaded_item_names = preloaded_item_names,
+                                 register = register, ts_override = ts_override)
+        finally:
+            # data prefetched for stages that did not execute must not leak into the next execution
+            self._release_prefetched_data(self.stages)
+            if self.entity_type.get_param('_trace_persist'):
+                try:
+                    self.entity_type.trace_flush()
+                except AttributeError:
+                    pass
+
+    def _execute(self, df=None, to_csv=False, dropna=False, start_ts = None, end_ts = None, entities = None, preloaded_item_names=None,
+                register = False, ts_override = True):
         '''
         Execute the pipeline using an input dataframe as source.
+        Set ts_override to False when the caller has already applied the start and
+        end timestamp overrides of the entity type.
         '''
         #preload may  have already taken place. if so pass the names of the items produced by stages that were executed prior to loading.
         if preloaded_item_names is None:
             preloaded_item_names = []
         msg = 'Executing pipeline with %s stages.' % len(self.stages)
-        logger.debug(msg)            
+        logger.debug(msg)
+        if self._profiler is None and self.entity_type.get_param('_profile_stages'):
+            self._profiler = StageProfiler(trace_memory = self.entity_type.get_param('_profile_memory'))
+        if self._stage_cache is None and self.entity_type.get_param('_stage_cache_dir') is not None:
+            self._stage_cache = StageCache(directory = self.entity_type.get_param('_stage_cache_dir'),
+                                           max_size = self.entity_type.get_param('_stage_cache_max_size'))
+        if self._capture is None and self.entity_type.get_param('_capture_dir') is not None:
+            self._capture = StageCapture(directory = self.entity_type.get_param('_capture_dir'),
+                                         compression = self.entity_type.get_param('_capture_compression'))
+        self._schema = None
+        self._conformed_index = None
+        self._index_producer = 'source'
+        self._index_rebuilds = []
+        if self.entity_type.get_param('_trace_persist'):
+            self.entity_type.trace_persist(execute_date = dt.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
         is_initial_transform = self.get_initial_transform_status()
+        new_checkpoints = None
         # A single execution can contain multiple CalcPipeline executions
         # An initial transform and one or more aggregation executions and post aggregation transforms
         # Behavior is different during initial transform
         if entities is None:
             entities = self.entity_type.get_entity_filter()
-        start_ts_override = self.entity_type.get_start_ts_override()
-        if start_ts_override is not None:
-            start_ts = start_ts_override
-        end_ts_override = self.entity_type.get_end_ts_override()            
-        if end_ts_override is not None:
-            end_ts = end_ts_override            
+        if ts_override:
+            (start_ts,end_ts) = self._apply_ts_override(start_ts,end_ts)
         if is_initial_transform:
             if not start_ts is None:
                 msg = 'Start timestamp: %s.' % start_ts
@@ -231,10 +410,33 @@ class CalcPipeline:
             #process preload stages first if there are any
             (stages,preload_item_names) = self._execute_preload_stages(start_ts = start_ts, end_ts = end_ts, entities = entities,register=register)
             preloaded_item_names.extend(preload_item_names)
+            null_rows_dropped = False
             if df is None:
                 msg = 'No dataframe supplied for pipeline execution. Getting entity source data'
                 logger.debug(msg)
-                df = self.entity_type.get_data(start_ts=start_ts, end_ts = end_ts, entities = entities)            
+                checkpoints = None
+                read_start_ts = start_ts
+                if self.entity_type.get_param('_incremental'):
+                    checkpoints = self.entity_type.get_checkpoints()
+                    read_start_ts = self._get_incremental_start(start_ts,checkpoints)
+                if self._profiler is not None:
+                    record = self._profiler.start(name = 'read_entity_data')
+                columns = self.entity_type.get_pipeline_source_items(self.stages)
+                null_rows_dropped = self._is_null_filter_pushable(stages)
+                if self.entity_type.get_param('_drop_all_null_rows') and not null_rows_dropped:
+                    #null rows are dropped after data sources are merged. Their
+                    #unprojected columns are needed to find rows that contain all nulls
+                    columns = None
+                df = self.entity_type.get_data(start_ts=read_start_ts, end_ts = end_ts, entities = entities,
+                                               columns = columns,
+                                               drop_all_null_rows = null_rows_dropped)
+                if checkpoints is not None and read_start_ts != start_ts:
+                    (df,start_ts) = self._read_new_entities(df,checkpoints,start_ts = start_ts, end_ts = read_start_ts,
+                                                            columns = columns, drop_all_null_rows = null_rows_dropped)
+                if self._profiler is not None:
+                    self._profiler.stop(record, df = df)
+                if checkpoints is not None:
+                    (df,new_checkpoints) = self._apply_checkpoints(df,checkpoints)
             #Divide the pipeline into data retrieval stages and transformation stages. First look for
             #a primary data source. A primary data source will have a merge_method of 'replace'. This
             #implies that it replaces whatever data was fed into the pipeline as default entity data.
@@ -250,31 +452,26 @@ class CalcPipeline:
                                                 )
                           
         else:
+            null_rows_dropped = False
             stages = []
             stages.extend(self.stages)
         if df is None:
             msg = 'Pipeline has no source dataframe'
             raise ValueError (msg)
-        if to_csv:
+        if self._capture is not None:
+            self._capture.capture('source',df)
+        elif to_csv:
             filename = 'debugPipelineSourceData.csv'
             df.to_csv(filename)
         if dropna:
             df = df.replace([np.inf, -np.inf], np.nan)
             df = df.dropna()
         # remove rows that contain all nulls ignore deviceid and timestamp
-        if self.entity_type.get_param('_drop_all_null_rows'):
-            exclude_cols = self.get_system_columns()
-            exclude_cols.extend(self.entity_type.get_param('_custom_exclude_col_from_auto_drop_nulls'))
-            msg = 'columns excluded when dropping null rows %s' %exclude_cols
-            logger.debug(msg)
-            subset = [x for x in df.columns if x not in exclude_cols]
-            msg = 'columns considered when dropping null rows %s' %subset
-            logger.debug(msg)
-            for col in subset:
-                count = df[col].count()
-                msg = '%s count not null: %s' %(col,count)
-                logger.debug(msg)
-            df = df.dropna(how='all', subset = subset )
+        # rows of a projected source were already filtered on all source columns by the database
+        if null_rows_dropped:
+            logger.debug('rows that contain all nulls were filtered out by the database')
+        elif self.entity_type.get_param('_drop_all_null_rows'):
+            df = self._drop_all_null_rows(df)
             self.log_df_info(df,'post drop all null rows')
         else:
             logger.debug('drop all null rows disabled')
@@ -282,20 +479,20 @@ class CalcPipeline:
         #added as the ui expects each stage to contribute one or more output items
         for pl in preloaded_item_names:
             df[pl] = True
-        for s in stages:
-            if df.empty:
-                self.logger.info('No data retrieved from all sources. Exiting pipeline execution')        
-                break
-                #skip this stage of it is not a secondary source             
-            df = self._execute_stage(stage=s,
-                                df = df,
-                                start_ts = start_ts,
-                                end_ts = end_ts,
-                                entities = entities,
-                                register = register,
-                                to_csv = to_csv,
-                                dropna = dropna,
-                                abort_on_fail = True)
+        self._live_items = self._get_live_items(stages)
+        partitions = self.entity_type.get_param('_entity_partitions')
+        if partitions is not None and partitions > 1:
+            execute_method = self._execute_partitioned_stages
+        else:
+            execute_method = self._execute_transform_stages
+        df = execute_method(stages = stages,
+                                            df = df,
+                                            start_ts = start_ts,
+                                            end_ts = end_ts,
+                                            entities = entities,
+                                            register = register,
+                                            to_csv = to_csv,
+                                            dropna = dropna)
         if is_initial_transform:
             try:
                 self.entity_type.write_unmatched_members(df)
@@ -304,36 +501,771 @@ class CalcPipeline:
                 self.trace_append(msg,created_by = self)
                 self.entity_type.raise_error(exception = e,abort_on_fail = False)
             self.mark_initial_transform_complete()
+        # checkpoints advance only after the caller has persisted the outputs
+        self._pending_checkpoints = new_checkpoints
+        if self._capture is not None:
+            self._capture.flush()
 
         return df
-    
-    
-    def _execute_stage(self,stage,df,start_ts,end_ts,entities,register,to_csv,dropna, abort_on_fail): 
+
+    def _drop_all_null_rows(self,df):
+        '''
+        Drop rows that contain all nulls ignoring system columns and excluded columns.
+        The row mask is built in a single pass over the numeric block. Per column
+        counts are only computed when debug logging is enabled.
+        '''
+        exclude_cols = list(self.get_system_columns())
+        exclude_cols.extend(self.entity_type.get_param('_custom_exclude_col_from_auto_drop_nulls'))
+        subset = [x for x in df.columns if x not in exclude_cols]
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = 'columns excluded when dropping null rows %s' %exclude_cols
+            logger.debug(msg)
+            for (col,count) in list(df[subset].count().items()):
+                msg = '%s count not null: %s' %(col,count)
+                logger.debug(msg)
+        float_cols = []
+        other_cols = []
+        for col in subset:
+            dtype = df[col].dtype
+            if isinstance(dtype,np.dtype) and dtype.kind in 'biu':
+                # numpy integer and boolean columns cannot contain nulls
+                return df
+            elif isinstance(dtype,np.dtype) and dtype.kind == 'f':
+                float_cols.append(col)
+            else:
+                other_cols.append(col)
+        mask = np.zeros(len(df.index),dtype=bool)
+        if len(float_cols) > 0:
+            mask = (~np.isnan(df[float_cols].to_numpy())).any(axis=1)
+        for col in other_cols:
+            if mask.all():
+                break
+            mask = mask | df[col].notna().to_numpy()
+        if mask.all():
+            return df
+        msg = 'Dropping %s rows that contain all nulls' %(len(mask) - mask.sum())
+        logger.debug(msg)
+        return df[mask]
+
+    def _is_null_filter_pushable(self,stages):
+        '''
+        Rows that contain all nulls can be filtered out in the database when no
+        stage adds data to the source rows before null rows are dropped
+        '''
+        if not self.entity_type.get_param('_drop_all_null_rows'):
+            return False
+        for s in stages:
+            if (getattr(s,'is_data_source',False) or getattr(s,'is_scd_lookup',False)
+                    or getattr(s,'is_custom_calendar',False)):
+                return False
+        return True
+
+    def commit_checkpoints(self):
+        '''
+        Write the checkpoints of the last incremental execution. Call after the
+        outputs of the execution have been persisted so that a failed write does
+        not skip data in the next incremental execution.
+        '''
+        checkpoints = self._pending_checkpoints
+        self._pending_checkpoints = None
+        if checkpoints is not None:
+            self.entity_type.write_checkpoints(checkpoints)
+
+    def _get_entity_ids(self,start_ts,end_ts):
+        '''
+        Get the list of entity ids to process. The ids are taken from the dimension
+        table when there is one. Otherwise the time series table is queried.
+        '''
+        entities = self.entity_type.get_dimension_entity_ids()
+        if entities is None:
+            entities = self.entity_type.get_entity_ids(start_ts = start_ts, end_ts = end_ts)
+        return entities
+
+    def _read_new_entities(self,df,checkpoints,start_ts,end_ts,columns,drop_all_null_rows):
+        '''
+        Entities in the checkpoint table were processed up to their checkpoints.
+        Entities of an incremental read that are not in the checkpoint table are
+        new. Read their data from before the incremental start so that they are
+        processed in full. Returns a tuple containing the dataframe and the start
+        timestamp of the data it contains.
+        '''
+        if not self.entity_type.get_param('_checkpoint_by_entity'):
+            return (df,end_ts)
+        ids = pd.unique(df.index.get_level_values(self.entity_type._df_index_entity_id).astype(object))
+        new_entities = [x for x in ids if x not in checkpoints]
+        if len(new_entities) == 0:
+            return (df,end_ts)
+        msg = '%s entities have no checkpoint. Processing their data from %s. ' %(len(new_entities),start_ts)
+        self.trace_append(msg)
+        earlier = self.entity_type.get_data(start_ts = start_ts, end_ts = end_ts, entities = new_entities,
+                                            columns = columns, drop_all_null_rows = drop_all_null_rows)
+        if earlier is None or earlier.empty:
+            return (df,end_ts)
+        df = pd.concat([earlier,df],sort = False)
+        if self.entity_type.get_param('_encode_entity_ids'):
+            df = self.entity_type.encode_df_entity_ids(df)
+        return (df.sort_index(),start_ts)
+
+    def _get_checkpoint_backtrack(self):
+        backtrack = self.entity_type.get_param('_checkpoint_backtrack')
+        if backtrack is None:
+            return pd.Timedelta(0)
+        return pd.Timedelta(backtrack)
+
+    def _get_incremental_start(self,start_ts,checkpoints):
+        '''
+        Get the start timestamp for an incremental read. Data is read from the
+        earliest checkpoint less the backtrack. The data of entities that have
+        no checkpoint is read separately by _read_new_entities.
+        '''
+        if len(checkpoints) == 0:
+            msg = 'No checkpoints recorded. Processing all data from %s' %start_ts
+            logger.debug(msg)
+            return start_ts
+        incremental_start = min(checkpoints.values()) - self._get_checkpoint_backtrack()
+        if start_ts is None or incremental_start > start_ts:
+            start_ts = incremental_start
+        msg = 'Incremental processing from checkpoint. Start timestamp: %s.' %start_ts
+        self.trace_append(msg)
+        return start_ts
+
+    def _apply_checkpoints(self,df,checkpoints):
+        '''
+        Remove rows that are older than the checkpoint of their entity less the
+        backtrack. Returns the filtered dataframe and the new checkpoints.
+        '''
+        # entity ids and timestamps are read from the index as their columns may not be materialized
+        entity_ids = pd.Series(df.index.get_level_values(self.entity_type._df_index_entity_id))
+        timestamps = pd.Series(df.index.get_level_values(self.entity_type._timestamp))
+        backtrack = self._get_checkpoint_backtrack()
+        if self.entity_type.get_param('_checkpoint_by_entity'):
+            if is_categorical_dtype(entity_ids):
+                #map encoded entity ids as strings so that thresholds are timestamps
+                entity_ids = entity_ids.astype(object)
+            thresholds = entity_ids.map(checkpoints)
+            keep = (thresholds.isnull() | (timestamps > thresholds - backtrack)).values
+            df = df[keep]
+            new_checkpoints = timestamps[keep].groupby(entity_ids[keep].values,observed=True).max().to_dict()
+        else:
+            if len(checkpoints) > 0:
+                keep = (timestamps > checkpoints[None] - backtrack).values
+                df = df[keep]
+                timestamps = timestamps[keep]
+            new_checkpoints = {}
+            if not df.empty:
+                new_checkpoints[None] = timestamps.max()
+        for (key,value) in list(new_checkpoints.items()):
+            if key in checkpoints and checkpoints[key] > value:
+                new_checkpoints[key] = checkpoints[key]
+        msg = 'Retained %s rows newer than checkpoints. ' %len(df.index)
+        self.trace_append(msg)
+        return (df,new_checkpoints)
+
+    def _apply_ts_override(self,start_ts,end_ts):
+        '''
+        Replace the start and end timestamps with the overrides set on the entity type
+        '''
+        start_ts_override = self.entity_type.get_start_ts_override()
+        if start_ts_override is not None:
+            start_ts = start_ts_override
+        end_ts_override = self.entity_type.get_end_ts_override()
+        if end_ts_override is not None:
+            end_ts = end_ts_override
+        return (start_ts,end_ts)
+
+    def execute_windows(self, to_csv=False, dropna=False, start_ts = None, end_ts = None, entities = None,
+                        register = False):
+        '''
+        Execute the pipeline over a time range in windows of size _stream_window,
+        optionally in batches of _stream_entity_batch_size entities. Each window is
+        read, transformed and yielded as a tuple of (window_start, window_end, df)
+        so that the caller can write it out before the next window is read. The
+        checkpoints of a window are written when the caller asks for the next window.
+        '''
+        window = self.entity_type.get_param('_stream_window')
+        if window is None:
+            msg = 'The entity type has no _stream_window. Set it to a pandas frequency string to execute in windows'
+            raise ValueError(msg)
+        if entities is None:
+            entities = self.entity_type.get_entity_filter()
+        (start_ts,end_ts) = self._apply_ts_override(start_ts,end_ts)
+        if end_ts is None:
+            end_ts = dt.datetime.utcnow()
+        if start_ts is None:
+            start_ts = self.entity_type.get_first_timestamp()
+            if start_ts is None:
+                logger.info('No data in the time series table. Nothing to execute')
+                return
+        batch_size = self.entity_type.get_param('_stream_entity_batch_size')
+        if batch_size is None:
+            batches = [entities]
+        else:
+            if entities is None:
+                entities = self._get_entity_ids(start_ts = start_ts, end_ts = end_ts)
+            batches = [entities[i:i+batch_size] for i in range(0,len(entities),batch_size)]
+        boundaries = list(pd.date_range(start = start_ts, end = end_ts, freq = window))
+        if len(boundaries) == 0 or boundaries[0] > pd.Timestamp(start_ts):
+            boundaries.insert(0,pd.Timestamp(start_ts))
+        if boundaries[-1] < pd.Timestamp(end_ts):
+            boundaries.append(pd.Timestamp(end_ts))
+        msg = 'Executing pipeline in %s windows of %s and %s entity batches' %(len(boundaries)-1,window,len(batches))
+        logger.debug(msg)
+        for i in range(len(boundaries)-1):
+            for batch in batches:
+                # each window is a separate initial transform of newly read data
+                self.entity_type._is_initial_transform = True
+                df = self.execute(to_csv = to_csv,
+                                  dropna = dropna,
+                                  start_ts = boundaries[i].to_pydatetime(),
+                                  end_ts = boundaries[i+1].to_pydatetime(),
+                                  entities = batch,
+                                  register = register,
+                                  ts_override = False)
+                yield (boundaries[i],boundaries[i+1],df)
+                self.commit_checkpoints()
+                del df
+
+    def _build_stage_levels(self,stages):
+        '''
+        Group stages into levels using the _input_set and _output_list of each
+        stage. Stages in the same level do not depend on each other.
+        Return None when a stage does not describe its inputs and outputs.
+        '''
+        stage_levels = []
+        barriers = []
+        for i,s in enumerate(stages):
+            try:
+                inputs = set(s._input_set)
+                outputs = set(s._output_list)
+            except (AttributeError,TypeError):
+                msg = 'Stage %s has no _input_set or _output_list. Stages will be executed serially' %s.__class__.__name__
+                logger.debug(msg)
+                return None
+            is_barrier = self._is_level_barrier(s)
+            level = 0
+            for j in range(i):
+                prior = stages[j]
+                prior_outputs = set(prior._output_list)
+                if (is_barrier or barriers[j] or
+                    len(inputs & prior_outputs) > 0 or
+                    len(outputs & prior_outputs) > 0 or
+                    len(outputs & set(prior._input_set)) > 0):
+                    level = max(level,stage_levels[j] + 1)
+            stage_levels.append(level)
+            barriers.append(is_barrier)
+        levels = []
+        for i,s in enumerate(stages):
+            while len(levels) <= stage_levels[i]:
+                levels.append([])
+            levels[stage_levels[i]].append(s)
+        msg = 'Scheduled %s stages into %s levels' %(len(stages),len(levels))
+        logger.debug(msg)
+        return levels
+
+    def _fuse_stages(self,stages):
+        '''
+        Replace runs of consecutive row-wise stages with a single FusedStage
+        '''
+        fused = []
+        run = []
+        for s in stages + [None]:
+            if s is not None and self._is_fusable_stage(s):
+                run.append(s)
+                continue
+            if len(run) > 1:
+                fused.append(FusedStage(run))
+                msg = 'Fused row-wise stages %s' %[x.__class__.__name__ for x in run]
+                logger.debug(msg)
+            else:
+                fused.extend(run)
+            run = []
+            if s is not None:
+                fused.append(s)
+        return fused
+
+    def _is_fusable_stage(self,stage):
+        return (getattr(stage,'is_row_wise',False) and
+                getattr(stage,'_abort_on_fail',True) and
+                not getattr(stage,'returns_column_delta',False))
+
+    def _is_stage_barrier(self,stage):
+        '''
+        Stages that add or remove rows must run on their own
+        '''
+        for prop in ['is_filter','is_data_source']:
+            try:
+                if getattr(stage,prop):
+                    return True
+            except AttributeError:
+                pass
+        return False
+
+    def _is_level_barrier(self,stage):
+        '''
+        Stages that must run on their own level. In addition to stages that add
+        or remove rows, these are stages that read items they do not declare and
+        stages that do not declare that they are free of side effects.
+        '''
+        if isinstance(stage,FusedStage):
+            return any([self._is_level_barrier(s) for s in stage.stages])
+        if self._is_stage_barrier(stage):
+            return True
+        if getattr(stage,'requires_all_source_items',False) or getattr(stage,'has_side_effects',True):
+            return True
+        return not getattr(stage,'_input_set',None)
+
+    def _execute_transform_stages(self,stages,df,start_ts,end_ts,entities,register,to_csv,dropna):
+        '''
+        Execute transform stages in sequence. When the entity type has
+        _parallel_stages set, independent stages are executed concurrently.
+        '''
+        if self.entity_type.get_param('_fuse_stages'):
+            stages = self._fuse_stages(stages)
+        levels = None
+        if self.entity_type.get_param('_parallel_stages'):
+            levels = self._build_stage_levels(stages)
+        if levels is None:
+            levels = [[s] for s in stages]
+        spiller = None
+        if self.entity_type.get_param('_memory_budget') is not None:
+            spiller = ColumnSpiller(budget = self.entity_type.get_param('_memory_budget'),
+                                    directory = self.entity_type.get_param('_spill_dir'))
         try:
-            abort_on_fail = stage._abort_on_fail
+            df = self._execute_stage_levels(levels = levels,
+                                            df = df,
+                                            start_ts = start_ts,
+                                            end_ts = end_ts,
+                                            entities = entities,
+                                            register = register,
+                                            to_csv = to_csv,
+                                            dropna = dropna,
+                                            spiller = spiller)
+            if spiller is not None:
+                spiller.restore(df)
+        finally:
+            if spiller is not None:
+                spiller.close()
+        return df
+
+    def _execute_stage_levels(self,levels,df,start_ts,end_ts,entities,register,to_csv,dropna,spiller=None):
+        '''
+        Execute levels of stages in sequence. When a spiller is supplied, cold columns
+        are spilled after each level and restored before the stages that need them.
+        '''
+        for (position,level) in enumerate(levels):
+            if df.empty:
+                self.logger.info('No data retrieved from all sources. Exiting pipeline execution')
+                break
+            if spiller is not None:
+                spiller.restore(df,self._get_level_inputs(level))
+            if len(level) == 1:
+                df = self._execute_stage(stage=level[0],
+                                    df = df,
+                                    start_ts = start_ts,
+                                    end_ts = end_ts,
+                                    entities = entities,
+                                    register = register,
+                                    to_csv = to_csv,
+                                    dropna = dropna,
+                                    abort_on_fail = True)
+            else:
+                df = self._execute_stage_level(level = level,
+                                    df = df,
+                                    start_ts = start_ts,
+                                    end_ts = end_ts,
+                                    entities = entities,
+                                    register = register,
+                                    to_csv = to_csv,
+                                    dropna = dropna)
+            self._drop_dead_items(df,level)
+            if spiller is not None:
+                (df,spilled) = spiller.spill(df,self._get_spill_order(df,levels,position + 1))
+                if len(spilled) > 0:
+                    msg = 'Spilled %s columns to keep within the memory budget. ' %len(spilled)
+                    self.trace_append(msg)
+        return df
+
+    def _get_level_inputs(self,level):
+        '''
+        Get the set of items used by a level of stages. Returns None when the
+        inputs of a stage are not known.
+        '''
+        inputs = set()
+        for s in level:
+            if getattr(s,'requires_all_source_items',False) or getattr(s,'_input_set',None) is None:
+                return None
+            inputs |= set(s._input_set)
+            inputs |= set(getattr(s,'execute_by',None) or [])
+            for method in ['get_input_items','get_source_items']:
+                try:
+                    inputs |= set(getattr(s,method)())
+                except AttributeError:
+                    pass
+        return inputs
+
+    def _get_spill_order(self,df,levels,position):
+        '''
+        Get the columns that may be spilled ordered from coldest to hottest.
+        Columns that no remaining stage uses are coldest. The rest are ordered
+        by how late they are needed. Columns needed by the next level and
+        system columns are never spilled.
+        '''
+        next_use = {}
+        for i in range(position,len(levels)):
+            inputs = self._get_level_inputs(levels[i])
+            if inputs is None:
+                inputs = set(df.columns)
+            for c in inputs:
+                next_use.setdefault(c,i)
+            if len(next_use) >= len(df.columns):
+                break
+        exclude = set(self.get_system_columns())
+        candidates = [x for x in df.columns if x not in exclude and next_use.get(x) != position]
+        return sorted(candidates, key = lambda x : -next_use.get(x,len(levels)))
+
+    def _get_live_items(self,stages):
+        '''
+        Get a dictionary keyed on stage id containing the set of items that must
+        remain in the dataframe after the stage has executed. These are the data items
+        of the entity type and the inputs of later stages. Returns None when
+        the inputs of a stage are not known.
+        '''
+        if not self.entity_type.get_param('_drop_dead_items'):
+            return None
+        data_items = self.entity_type.get_data_items()
+        if data_items is None:
+            return None
+        live = set(self.get_system_columns())
+        for item in data_items:
+            live.add(item.get('name'))
+            live.add(item.get('columnName'))
+        live_items = {}
+        for s in reversed(stages):
+            live_items[id(s)] = set(live)
+            if getattr(s,'requires_all_source_items',False) or getattr(s,'_input_set',None) is None:
+                msg = 'Stage %s has no input set. Intermediate items will not be dropped' %s.__class__.__name__
+                logger.debug(msg)
+                return None
+            live |= set(s._input_set)
+            #stages executed by a key group on the key columns
+            live |= set(getattr(s,'execute_by',None) or [])
+            for method in ['get_input_items','get_source_items']:
+                try:
+                    live |= set(getattr(s,method)())
+                except AttributeError:
+                    pass
+        return live_items
+
+    def _drop_dead_items(self,df,level):
+        '''
+        Drop columns that are not needed after a level of stages has executed.
+        Columns are deleted in place so the rest of the dataframe is not copied.
+        '''
+        if self._live_items is None:
+            return df
+        live = set()
+        for s in level:
+            if isinstance(s,FusedStage):
+                members = s.stages
+            else:
+                members = [s]
+            for m in members:
+                try:
+                    live |= self._live_items[id(m)]
+                except KeyError:
+                    return df
+        dead = [x for x in df.columns if x not in live]
+        for c in dead:
+            del df[c]
+        if len(dead) > 0:
+            self.trace_append('Dropped items no longer needed by the pipeline: %s. ', args = (dead,),
+                              level = logging.DEBUG)
+        return df
+
+    def _is_cross_entity_stage(self,stage):
+        '''
+        Stages that need data for all entities cannot execute in entity partitions.
+        Stages executed by keys that do not include the entity id need data for all entities.
+        '''
+        try:
+            is_cross_entity = stage.is_cross_entity
         except AttributeError:
-            abort_on_fail = abort_on_fail
+            is_cross_entity = False
+        if is_cross_entity or self._is_stage_barrier(stage):
+            return True
+        execute_by = getattr(stage,'execute_by',None)
+        if execute_by:
+            entity_keys = set([self.entity_type._entity_id,self.entity_type._df_index_entity_id])
+            return len(set(execute_by) & entity_keys) == 0
+        return False
+
+    def _execute_partitioned_stages(self,stages,df,**kwargs):
+        '''
+        Execute runs of entity local stages in entity partitions. Cross entity
+        stages execute against the merged dataframe.
+        '''
+        segments = []
+        for s in stages:
+            is_local = not self._is_cross_entity_stage(s)
+            if len(segments) > 0 and segments[-1][0] == is_local:
+                segments[-1][1].append(s)
+            else:
+                segments.append((is_local,[s]))
+        for (is_local,segment) in segments:
+            if df.empty:
+                self.logger.info('No data retrieved from all sources. Exiting pipeline execution')
+                break
+            if is_local:
+                df = self._execute_entity_partitions(stages = segment, df = df, **kwargs)
+            else:
+                df = self._execute_transform_stages(stages = segment, df = df, **kwargs)
+        return df
+
+    def _execute_entity_partitions(self,stages,df,**kwargs):
+        '''
+        Split the dataframe into shards on the entity id index level and execute
+        stages for each shard in a pool of forked worker processes.
+        '''
+        global _partition_context
+        partitions = self.entity_type.get_param('_entity_partitions')
+        level = self.entity_type._df_index_entity_id
+        try:
+            entity_ids = df.index.get_level_values(level)
+        except KeyError:
+            msg = 'Dataframe has no index level %s. Executing stages without entity partitions' %level
+            logger.warning(msg)
+            return self._execute_transform_stages(stages = stages, df = df, **kwargs)
+        ids = entity_ids.unique()
+        partitions = min(partitions,len(ids))
+        try:
+            mp_context = multiprocessing.get_context('fork')
+        except ValueError:
+            logger.debug('Platform does not support fork. Executing stages without entity partitions')
+            partitions = 1
+        if partitions < 2:
+            return self._execute_transform_stages(stages = stages, df = df, **kwargs)
+        shards = [df[entity_ids.isin(x)] for x in np.array_split(ids,partitions)]
+        msg = 'Executing stages %s in %s entity partitions. ' %([s.__class__.__name__ for s in stages],partitions)
+        self.trace_append(msg)
+        _partition_context = (self,stages,shards,kwargs)
+        try:
+            with ProcessPoolExecutor(max_workers = partitions, mp_context = mp_context,
+                                     initializer = _init_partition_worker) as executor:
+                results = list(executor.map(_execute_partition,range(partitions)))
+        finally:
+            _partition_context = None
+        dfs = []
+        trace = getattr(self.entity_type,'_trace',None)
+        for (shard_df,entries,profile) in results:
+            dfs.append(shard_df)
+            if trace is not None:
+                trace.extend(entries)
+            if self._profiler is not None:
+                self._profiler.data.extend(profile)
+        df = pd.concat(dfs,sort=False)
+        msg = 'Merged output of entity partitions. '
+        self.trace_append(msg, df = df)
+        if self._capture is not None:
+            self._capture.capture('entity_partitions',df)
+        return df
+
+    def _execute_stage_level(self,level,df,start_ts,end_ts,entities,register,to_csv,dropna):
+        '''
+        Execute a level of independent stages on a thread pool. Each stage
+        receives a shallow copy of the dataframe. The output columns of each
+        stage are merged back into a single dataframe.
+        '''
+        msg = 'Executing independent stages %s concurrently. ' %[s.__class__.__name__ for s in level]
+        self.trace_append(msg)
+        self._is_executing_level = True
+        try:
+            with ThreadPoolExecutor(max_workers = self.entity_type.get_param('_max_stage_workers')) as executor:
+                futures = []
+                for s in level:
+                    futures.append(executor.submit(self._execute_stage,
+                                                   stage = s,
+                                                   df = df.copy(deep=False),
+                                                   start_ts = start_ts,
+                                                   end_ts = end_ts,
+                                                   entities = entities,
+                                                   register = register,
+                                                   to_csv = to_csv,
+                                                   dropna = dropna,
+                                                   abort_on_fail = True))
+                results = [f.result() for f in futures]
+        finally:
+            self._is_executing_level = False
+        input_df = df.copy(deep=False)
+        source_cols = set(df.columns)
+        for s,newdf in zip(level,results):
+            new_cols = [x for x in newdf.columns if x not in source_cols or x in s._output_list]
+            if not newdf.index.equals(df.index):
+                msg = ('Stage %s changed the index of the dataframe while executing'
+                       ' concurrently. Output columns will be aligned to the index' %s.__class__.__name__)
+                logger.warning(msg)
+            for c in new_cols:
+                df[c] = newdf[c]
+        msg = 'Merged output of concurrent stages. '
+        self.trace_append(msg, df = df)
+        self._update_schema(level,input_df,df)
+        return df
+
+    def _execute_stage(self,stage,df,start_ts,end_ts,entities,register,to_csv,dropna, abort_on_fail):
+        '''
+        Execute a single stage. Collect a profile of the stage when profiling is enabled.
+        '''
+        kwargs = {'stage' : stage,
+                  'df' : df,
+                  'start_ts' : start_ts,
+                  'end_ts' : end_ts,
+                  'entities' : entities,
+                  'register' : register,
+                  'to_csv' : to_csv,
+                  'dropna' : dropna,
+                  'abort_on_fail' : abort_on_fail}
+        if self._profiler is None:
+            return self._run_stage(**kwargs)
         try:
             name = stage.name
         except AttributeError:
             name = stage.__class__.__name__
-        #check to see if incoming data has a conformed index, conform if needed
-        try:
-            df = stage.conform_index(df=df)
-        except AttributeError:
-            pass
-        except KeyError as e:
-            msg = 'KeyError while conforming index prior to execution of function %s. ' %name
-            self.trace_append(msg,created_by = stage, df = df)
-            self.entity_type.raise_error(exception = e,abort_on_fail = abort_on_fail,stageName = name)
-        #there are two signatures for the execute method
-        msg = 'Stage %s :' % name
-        self.trace_append(msg=msg,df=df)
+        record = self._profiler.start(name = name, df = df)
+        newdf = None
         try:
+            newdf = self._run_stage(**kwargs)
+        finally:
+            self._profiler.stop(record, df = newdf)
+        return newdf
+
+    def _run_stage(self,stage,df,start_ts,end_ts,entities,register,to_csv,dropna, abort_on_fail):
+        plan = self._get_stage_plan(stage)
+        self._release_prefetched_data([stage],scope = (start_ts,end_ts,entities))
+        if plan.abort_on_fail is not None:
+            abort_on_fail = plan.abort_on_fail
+        name = plan.name
+        #check to see if incoming data has a conformed index, conform if needed
+        if plan.has_conform_index and not self._is_index_conformed(df):
+            if self._conformed_index is not None:
+                with self._lock:
+                    self._index_rebuilds.append((self._index_producer,name))
+                self.trace_append('Index was not conformed after %s. Rebuilding index before stage %s. ',
+                                  args = (self._index_producer,name))
             try:
-                newdf = stage.execute(df=df,start_ts=start_ts,end_ts=end_ts,entities=entities)
-            except TypeError:
-                newdf = stage.execute(df=df)
+                df = stage.conform_index(df=df)
+            except AttributeError as e:
+                msg = 'Unable to conform index prior to execution of function %s. %s' %(name,e)
+                logger.debug(msg)
+            except KeyError as e:
+                msg = 'KeyError while conforming index prior to execution of function %s. ' %name
+                self.trace_append(msg,created_by = stage, df = df)
+                self.entity_type.raise_error(exception = e,abort_on_fail = abort_on_fail,stageName = name)
+            else:
+                #concurrent stages receive copies of the pipeline dataframe and do not update the index state
+                if not self._is_executing_level:
+                    self._conformed_index = df.index
+        #stages of a pipeline add columns to the dataframe in place
+        #keep the incoming columns to compare the output with
+        input_columns = list(df.columns)
+        #index columns are only materialized for the stages that need them
+        index_columns = []
+        if plan.requires_index_columns and not self.entity_type.get_param('_index_columns'):
+            index_columns = self.entity_type.add_index_columns(df)
+        self.trace_append('Stage %s :', args = (name,), df = df, level = logging.DEBUG)
+        index_before = df.index
+        columns_before = set(df.columns)
+        cache_key = self._get_stage_cache_key(stage,df,start_ts,end_ts)
+        cached = None
+        if cache_key is not None:
+            cached = self._stage_cache.load(cache_key)
+        if cached is not None:
+            cached.index = df.index
+            newdf = self._attach_columns(df,cached)
+            self.trace_append('Loaded output of stage %s from the stage cache. ', args = (name,))
+        else:
+            newdf = self._call_stage(stage = stage,
+                                     df = df,
+                                     start_ts = start_ts,
+                                     end_ts = end_ts,
+                                     entities = entities,
+                                     name = name,
+                                     abort_on_fail = abort_on_fail)
+            if cache_key is not None:
+                self._store_stage_result(stage,cache_key,newdf,index_before,columns_before)
+        if index_columns:
+            self._drop_index_columns(stage,index_columns,df,newdf)
+        #validate that stage has not violated any pipeline processing rules
+        #stages executing concurrently are validated after their outputs are merged
+        if not self._is_executing_level:
+            self._update_schema([stage],df,newdf,input_columns = input_columns)
+        if register:
+            try:
+                stage.register(df=df[[x for x in input_columns if x in df.columns]],new_df= newdf)
+            except AttributeError as e:
+                msg = 'Could not export %s as it has no register() method or because an AttributeError was raised during execution' %name
+                logger.warning(msg)
+                logger.warning(str(e))
+        if dropna:
+            newdf = newdf.replace([np.inf, -np.inf], np.nan)
+            newdf = newdf.dropna()
+        if self._capture is not None:
+            self._capture_stage(stage,name,newdf,index_before,columns_before)
+        elif to_csv:
+            newdf.to_csv('debugPipelineOut_%s.csv' %stage.__class__.__name__)
+
+        if newdf.index is not df.index and not self._is_executing_level:
+            self._index_producer = name
+        self.trace_append('Completed stage %s. ', args = (name,), created_by=stage, df = newdf)
+        return newdf
+
+    def _is_index_conformed(self,df):
+        '''
+        Returns True when the dataframe is indexed on entity id and timestamp and has the
+        entity id and timestamp columns. The columns are not required when the
+        _index_columns param is False. The check is O(1). A dataframe that still has
+        the index that was last conformed is known to conform.
+        '''
+        if self.entity_type.get_param('_index_columns'):
+            if not (self.entity_type._timestamp_col in df.columns and self.entity_type._entity_id in df.columns):
+                return False
+        if df.index is self._conformed_index:
+            return True
+        if list(df.index.names) == [self.entity_type._df_index_entity_id,self.entity_type._timestamp]:
+            if not self._is_executing_level:
+                self._conformed_index = df.index
+            return True
+        return False
+
+    def _drop_index_columns(self,stage,columns,df,newdf):
+        '''
+        Remove index columns that were materialized for a stage from the input and
+        output dataframes. Columns that the stage declares as outputs are retained.
+        '''
+        outputs = getattr(stage,'_output_list',None) or []
+        for c in columns:
+            if c in outputs:
+                continue
+            for frame in [df,newdf]:
+                if c in frame.columns:
+                    del frame[c]
+                if newdf is df:
+                    break
+
+    def get_index_rebuilds(self):
+        '''
+        Get a list of tuples describing the index rebuilds of the last execution. Each
+        tuple contains the name of the stage that produced a dataframe with a non
+        conforming index and the name of the stage that the index was rebuilt for.
+        '''
+        return list(self._index_rebuilds)
+
+    def _call_stage(self,stage,df,start_ts,end_ts,entities,name,abort_on_fail):
+        '''
+        Call the execute method of a stage. Returns a dataframe containing
+        the pipeline dataframe and the outputs of the stage.
+        '''
+        plan = self._get_stage_plan(stage)
+        try:
+            newdf = plan.execute(df=df,start_ts=start_ts,end_ts=end_ts,entities=entities)
         except AttributeError as e:
             self.trace_append('The function %s makes a reference to an object property that does not exist. ' %name,
                               created_by = stage)
@@ -353,29 +1285,67 @@ class CalcPipeline:
         except BaseException as e:
             self.trace_append('The function %s failed to execute. ' %name, created_by = stage)
             self.entity_type.raise_error(exception = e,abort_on_fail = abort_on_fail,stageName = name)
-        #validate that stage has not violated any pipeline processing rules
+        #a stage may return only the columns that it added
+        if plan.returns_column_delta:
+            newdf = self._attach_columns(df,newdf)
+        return newdf
+
+    def _capture_stage(self,stage,name,newdf,index_before,columns_before):
+        '''
+        Capture the output of a stage. Only changed columns are captured when
+        the stage did not change the index and the capture mode is delta.
+        '''
+        if (self.entity_type.get_param('_capture_mode') == 'delta' and
+                (newdf.index is index_before or newdf.index.equals(index_before))):
+            outputs = set(getattr(stage,'_output_list',None) or [])
+            cols = [x for x in newdf.columns if x not in columns_before or x in outputs]
+            removed = [x for x in columns_before if x not in newdf.columns]
+            self._capture.capture(name,newdf,columns = cols,removed = removed)
+        else:
+            self._capture.capture(name,newdf)
+
+    def _get_stage_cache_key(self,stage,df,start_ts=None,end_ts=None):
+        '''
+        Get the stage cache key for a stage. Returns None when the stage cache
+        is disabled or the stage output cannot be cached.
+        '''
+        if self._stage_cache is None or not getattr(stage,'is_cacheable',False):
+            return None
+        if self._is_stage_barrier(stage) or getattr(stage,'_input_set',None) is None:
+            return None
+        items = set(stage._input_set)
         try:
-            self.validate_df(df,newdf)
+            items |= set(stage.get_input_items())
         except AttributeError:
-            msg = 'Function %s has no validate_df method. Skipping validation of the dataframe' %name
-            logger.debug(msg)
-        if register:
-            try:
-                stage.register(df=df,new_df= newdf)
-            except AttributeError as e:
-                msg = 'Could not export %s as it has no register() method or because an AttributeError was raised during execution' %name
-                logger.warning(msg)
-                logger.warning(str(e))
-        if dropna:
-            newdf = newdf.replace([np.inf, -np.inf], np.nan)
-            newdf = newdf.dropna()
-        if to_csv:
-            newdf.to_csv('debugPipelineOut_%s.csv' %stage.__class__.__name__)
+            pass
+        return self._stage_cache.get_key(stage,df,items,
+                                         constants = self.entity_type.get_constants(),
+                                         scope = (start_ts,end_ts))
 
-        msg = 'Completed stage %s. ' %name
-        self.trace_append(msg,created_by=stage, df = newdf)
-        return newdf
+    def _store_stage_result(self,stage,key,newdf,index_before,columns_before):
+        '''
+        Write the new and output columns of a stage to the stage cache
+        '''
+        if newdf is None or not newdf.index.equals(index_before):
+            msg = 'Stage %s changed the dataframe index. Output not cached' %stage.__class__.__name__
+            logger.debug(msg)
+            return
+        outputs = set(getattr(stage,'_output_list',None) or [])
+        cols = [x for x in newdf.columns if x not in columns_before or x in outputs]
+        if len(cols) > 0:
+            self._stage_cache.store(key,newdf[cols])
     
+    def _attach_columns(self,df,delta):
+        '''
+        Add the columns of a dataframe or series returned by a stage to the pipeline
+        dataframe without copying the pipeline dataframe
+        '''
+        if isinstance(delta,pd.Series):
+            delta = delta.to_frame()
+        for c in delta.columns:
+            df[c] = delta[c]
+        return df
+
     def get_custom_calendar(self):
         '''
         Get the optional custom calendar for the entity type
@@ -388,6 +1358,15 @@ class CalcPipeline:
         '''
         return self.entity_type._is_initial_transform    
     
+    def get_profile(self):
+        '''
+        Get the stage profile collected during execution as a dict.
+        Set _profile_stages on the entity type to collect a profile.
+        '''
+        if self._profiler is None:
+            return None
+        return self._profiler.as_dict()
+
     def get_input_items(self):
         '''
         Get the set of input items explicitly requested by each function
@@ -467,11 +1446,21 @@ class CalcPipeline:
                 )
 
             
+    def save_profile(self,filename='pipeline_profile.json'):
+        '''
+        Write the stage profile to a json file
+        '''
+        if self._profiler is None:
+            msg = 'No profile collected. Set _profile_stages on the entity type to profile pipeline stages'
+            raise ValueError(msg)
+        return self._profiler.save(filename)
+
     def set_stages(self,stages):
         '''
         Replace existing stages with a new list of stages
         '''
         self.stages = []
+        self._stage_plans = {}
         if not stages is None:
             if not isinstance(stages,list):
                 stages = [stages]
@@ -481,6 +1470,28 @@ class CalcPipeline:
                 s.set_entity_type(self.entity_type)
             except AttributeError:
                 s._entity_type = self.entity_type
+            s._is_pipeline_stage = True
+            self._stage_plans[id(s)] = StagePlan(s,index_columns = self._get_index_columns())
+            
+    def _get_stage_plan(self,stage):
+        '''
+        Get the invocation plan of a stage. Plans of stages that were not
+        added to the pipeline, e.g. fused stages, are built on each use and not
+        cached so that they do not keep the stages alive.
+        '''
+        try:
+            plan = self._stage_plans[id(stage)]
+        except KeyError:
+            plan = None
+        if plan is None or plan.stage is not stage:
+            plan = StagePlan(stage,index_columns = self._get_index_columns())
+        return plan
+
+    def _get_index_columns(self):
+        '''
+        Get the names of the columns that copy the entity id and timestamp index levels
+        '''
+        return [self.entity_type._entity_id,self.entity_type._timestamp_col]
                 
     def __str__(self):
         
@@ -498,6 +1509,17 @@ class CalcPipeline:
                                       log_method=log_method,
                                       **kwargs)
 
+    def _update_schema(self,stages,input_df,output_df,input_columns = None):
+        '''
+        Validate the output of stages against the schema tracked since the
+        source was read. The schema tracker is started by the first stage.
+        Supply input_columns when the stages changed the input dataframe in place.
+        '''
+        if self._schema is None:
+            self._schema = SchemaTracker(self.entity_type)
+            self._schema.start(input_df,columns = input_columns)
+        self._schema.update(stages,input_df,output_df,input_columns = input_columns)
+
     def validate_df(self, input_df, output_df):
 
         validation_result = {}
@@ -515,7 +1537,8 @@ class CalcPipeline:
             validation_result[df_name]['columns'] = set(df.columns)
             is_str_0 = False
             try:
-                if is_string_dtype(df.index.get_level_values(self.entity_type._df_index_entity_id)):
+                ids = df.index.get_level_values(self.entity_type._df_index_entity_id)
+                if is_string_dtype(ids) or is_categorical_dtype(ids):
                     is_str_0 = True
             except KeyError:
                 pass
@@ -603,7 +1626,7 @@ class CalcPipeline:
 
                 # check if it is String
                 if data_item['columnType'] == 'LITERAL':
-                    if not is_string_dtype(df_column.dtype):
+                    if not (is_string_dtype(df_column.dtype) or is_categorical_dtype(df_column.dtype)):
                         logger.info(
                             'Type is not consistent %s: df type is %s and data type is %s' % (
                                 item, df_column.dtype.name, data_item['columnType']))
@@ -648,10 +1671,306 @@ class CalcPipeline:
             raise Exception(msg)
 
 
+class StagePlan(object):
+    '''
+    Describe how the pipeline invokes a stage. The plan is built once from
+    the signature of the execute method and the capability flags of the
+    stage so that execution dispatches without probing the stage.
+    '''
+    def __init__(self,stage,index_columns = None):
+        self.stage = stage
+        self.name = getattr(stage,'name',stage.__class__.__name__)
+        self.abort_on_fail = getattr(stage,'_abort_on_fail',None)
+        self.is_preload = getattr(stage,'is_preload',False)
+        self.is_independent = getattr(stage,'is_independent',False)
+        self.returns_column_delta = getattr(stage,'returns_column_delta',False)
+        self.has_conform_index = hasattr(stage,'conform_index')
+        # a data source must also have a merge method
+        self.is_data_source = getattr(stage,'is_data_source',False) and hasattr(stage,'merge_method')
+        self.merge_method = getattr(stage,'merge_method',None) if self.is_data_source else None
+        self.has_scd_lookup = hasattr(stage,'is_scd_lookup')
+        self.is_scd_lookup = getattr(stage,'is_scd_lookup',False)
+        self.has_custom_calendar = hasattr(stage,'is_custom_calendar')
+        self.is_custom_calendar = getattr(stage,'is_custom_calendar',False)
+        # there are two signatures for the execute method
+        self.accepts_scope = self._accepts_scope(stage)
+        self.requires_index_columns = self._requires_index_columns(stage,index_columns)
+        
+    def _requires_index_columns(self,stage,index_columns):
+        '''
+        Returns True when the stage declares that it needs the index columns or
+        references an index column in its inputs, execute_by or expression.
+        Stages that do not declare their inputs are assumed to need them.
+        '''
+        required = getattr(stage,'requires_index_columns',None)
+        if required is not None:
+            return required
+        if not index_columns:
+            return True
+        if isinstance(stage,FusedStage):
+            return any([self._requires_index_columns(s,index_columns) for s in stage.stages])
+        inputs = getattr(stage,'_input_set',None)
+        if not inputs:
+            try:
+                inputs = stage.get_input_items()
+            except (AttributeError,TypeError,KeyError):
+                inputs = None
+        if not inputs:
+            # the stage may read any column of the dataframe
+            return True
+        inputs = set(inputs)
+        inputs |= set(getattr(stage,'execute_by',None) or [])
+        expression = getattr(stage,'expression',None)
+        for c in index_columns:
+            if c in inputs:
+                return True
+            if isinstance(expression,str) and c in expression:
+                return True
+        return False
+        
+    def _accepts_scope(self,stage):
+        '''
+        Returns True when the execute method accepts start_ts, end_ts and entities.
+        Returns None when the signature cannot be inspected.
+        '''
+        try:
+            parameters = inspect.signature(stage.execute).parameters
+        except AttributeError:
+            return False
+        except (TypeError,ValueError):
+            return None
+        if any([x.kind == x.VAR_KEYWORD for x in parameters.values()]):
+            return True
+        return all([x in parameters for x in ['start_ts','end_ts','entities']])
+        
+    def execute(self,df,start_ts=None,end_ts=None,entities=None):
+        '''
+        Call the execute method of the stage using the signature it supports
+        '''
+        if self.accepts_scope:
+            return self.stage.execute(df=df,start_ts=start_ts,end_ts=end_ts,entities=entities)
+        elif self.accepts_scope is None:
+            try:
+                return self.stage.execute(df=df,start_ts=start_ts,end_ts=end_ts,entities=entities)
+            except TypeError:
+                return self.stage.execute(df=df)
+        return self.stage.execute(df=df)
+
+
+class SchemaTracker(object):
+    '''
+    Track the dtypes of the pipeline dataframe as stages execute. The dtypes
+    are recorded once when the tracker is started and then updated from the
+    columns that each stage adds, removes or declares as outputs. The data item
+    metadata of the entity type is compiled once into a map of expected column
+    types so that type reconciliation only touches new or changed columns.
+    '''
+    def __init__(self,entity_type):
+        self.entity_type = entity_type
+        self.dtypes = {}
+        self.expected_types = self.get_expected_types(entity_type.get_data_items())
+        
+    def get_expected_types(self,items):
+        '''
+        Get a dict of column types keyed on data item name
+        '''
+        if items is None:
+            return {}
+        try:
+            items = [items.get(x) for x in list(items.data_items)]
+        except AttributeError:
+            pass
+        expected = {}
+        for item in items:
+            try:
+                expected[item['name']] = item['columnType']
+            except (KeyError,TypeError):
+                continue
+        return expected
+    
+    def start(self,df,columns = None):
+        '''
+        Record the dtypes of a dataframe and reconcile the types of all data items.
+        Supply columns to record only the columns that the dataframe had before a
+        stage added columns to it in place.
+        '''
+        self.dtypes = dict(df.dtypes.items())
+        if columns is not None:
+            self.dtypes = {x : self.dtypes[x] for x in columns if x in self.dtypes}
+        self._check_index(df,'Input')
+        self.reconcile(df,list(self.dtypes.keys()))
+        
+    def update(self,stages,input_df,output_df,input_columns = None):
+        '''
+        Update the tracked dtypes from the columns changed by stages. Warn about
+        columns that were dropped or changed type and reconcile the types of
+        new or changed columns with the data item metadata. Supply the list of
+        input_columns when the stages changed the input dataframe in place.
+        '''
+        if len(output_df.index) == 0:
+            logger.warning('Output dataframe has no rows of data')
+        if output_df.index is not input_df.index:
+            self._check_index(output_df,'Output')
+        changed = []
+        if input_columns is None:
+            is_changed = output_df.columns is not input_df.columns and not output_df.columns.equals(input_df.columns)
+            input_columns = input_df.columns
+        else:
+            is_changed = list(output_df.columns) != list(input_columns)
+        if is_changed:
+            input_cols = set(input_columns)
+            output_cols = set(output_df.columns)
+            changed = [x for x in output_df.columns if x not in input_cols]
+            removed = [x for x in input_columns if x not in output_cols]
+            if len(removed) > 0:
+                msg = 'Output dataframe is missing columns %s. Either the type has changed or column was dropped' %removed
+                logger.warning(msg)
+                for c in removed:
+                    self.dtypes.pop(c,None)
+        else:
+            output_cols = None
+        outputs = []
+        for s in stages:
+            stage_outputs = getattr(s,'_output_list',None)
+            if stage_outputs is None:
+                outputs = None
+                break
+            outputs.extend(stage_outputs)
+        if outputs is None:
+            # outputs are not known. Compare all dtypes.
+            changed = [x for (x,dtype) in list(output_df.dtypes.items()) if self.dtypes.get(x) != dtype]
+        else:
+            if output_cols is None:
+                output_cols = output_df.columns
+            changed.extend([x for x in outputs if x in output_cols and x not in changed])
+        new_types = {}
+        for c in changed:
+            try:
+                new_types[c] = output_df[c].dtype
+            except AttributeError:
+                # duplicate column names
+                continue
+            previous = self.dtypes.get(c)
+            if previous is not None and previous != new_types[c]:
+                msg = 'Column %s changed type from %s to %s' %(c,previous,new_types[c])
+                logger.warning(msg)
+        self.dtypes.update(new_types)
+        self.reconcile(output_df,list(new_types.keys()))
+        
+    def _check_index(self,df,df_name):
+        
+        is_id_dtype = lambda x : is_string_dtype(x) or is_categorical_dtype(x)
+        for (name,check,description) in [(self.entity_type._df_index_entity_id,is_id_dtype,'First part not a string'),
+                                         (self.entity_type._timestamp,is_datetime64_any_dtype,'Second part not a string')]:
+            try:
+                level = df.index.names.index(name)
+            except ValueError:
+                conforms = False
+            else:
+                try:
+                    dtype = df.index.levels[level].dtype
+                except AttributeError:
+                    dtype = df.index.dtype
+                conforms = check(dtype)
+            if not conforms:
+                logger.warning('%s dataframe index does not conform. %s called %s' %(df_name,description,name))
+    
+    def reconcile(self,df,columns):
+        '''
+        Convert columns to the type of their data item in place. Raises an
+        exception when a column could not be converted.
+        '''
+        invalid_data_items = []
+        for c in columns:
+            try:
+                column_type = self.expected_types[c]
+            except KeyError:
+                continue
+            dtype = self.dtypes.get(c)
+            if dtype is None:
+                continue
+            if column_type == 'NUMBER':
+                valid = is_numeric_dtype(dtype) and not is_bool_dtype(dtype)
+                convert = lambda x : x.astype('float64')
+            elif column_type == 'LITERAL':
+                valid = is_string_dtype(dtype) or is_categorical_dtype(dtype)
+                convert = lambda x : x.astype('str')
+            elif column_type == 'TIMESTAMP':
+                valid = is_datetime64_any_dtype(dtype)
+                convert = pd.to_datetime
+            elif column_type == 'BOOLEAN':
+                valid = is_bool_dtype(dtype)
+                convert = lambda x : x.astype('bool')
+            else:
+                continue
+            if valid:
+                continue
+            logger.info('Type is not consistent %s: df type is %s and data type is %s' % (c, dtype.name, column_type))
+            try:
+                df[c] = convert(df[c])
+            except Exception:
+                invalid_data_items.append((c, dtype.name, column_type))
+            else:
+                self.dtypes[c] = df[c].dtype
+        if len(invalid_data_items) > 0:
+            msg = 'Some data items could not have its type conciliated:'
+            for item, df_type, data_type in invalid_data_items:
+                msg += ('\n %s: df type is %s and data type is %s' % (item, df_type, data_type))
+            logger.error(msg)
+            raise Exception(msg)
+
+
+class FusedStage(object):
+    '''
+    Execute a run of row-wise stages as a single pipeline stage. The pipeline
+    conforms the index, validates and traces once for the whole run.
+    '''
+    is_cacheable = False
+    
+    def __init__(self,stages):
+        self.stages = stages
+        self.name = 'fused[%s]' %','.join([getattr(s,'name',s.__class__.__name__) for s in stages])
+        self._abort_on_fail = True
+        try:
+            self._input_set = set()
+            self._output_list = []
+            for s in stages:
+                self._input_set |= set(s._input_set) - set(self._output_list)
+                self._output_list.extend(s._output_list)
+        except (AttributeError,TypeError):
+            self._input_set = None
+            self._output_list = None
+        
+    def conform_index(self,df):
+        return self.stages[0].conform_index(df=df)
+    
+    def execute(self,df):
+        for s in self.stages:
+            df = s.execute(df=df)
+        return df
+    
+    def get_input_items(self):
+        items = set()
+        for s in self.stages:
+            try:
+                items |= set(s.get_input_items())
+            except AttributeError:
+                pass
+        return items
+    
+    def register(self,df,new_df):
+        for s in self.stages:
+            s.register(df=df,new_df=new_df)
+            
+
 class PipelineExpression(object):
     '''
     Create a new item from an expression involving other items
     '''
+    # execute returns only the new item. The pipeline attaches it to the pipeline dataframe
+    returns_column_delta = True
+    has_side_effects = False
+
     def __init__(self, expression , name, entity_type):
         self.expression = expression
         self.name = name
@@ -660,21 +1979,19 @@ class PipelineExpression(object):
         self.entity_type = entity_type
                 
     def execute(self, df):
-        df = df.copy()
         self.infer_inputs(df)
-        if '${' in self.expression:
-            expr = re.sub(r"\$\{(\w+)\}", r"df['\1']", self.expression)
-        else:
-            expr = self.expression
         try:
-            df[self.name] = eval(expr)
+            expr = compile_expression(self.expression)
+            result = pd.DataFrame({self.name : expr.evaluate(df, local_dict = {'self' : self}, global_dict = globals())},
+                                  index = df.index)
         except SyntaxError:
+            expr = self.expression
             msg = 'Syntax error while evaluating expression %s' %expr
             raise SyntaxError (msg)
         else:
             msg = 'Evaluated expression %s' %expr
-            self.entity_type.trace_append(msg,df=df)
-        return df
+            self.entity_type.trace_append(self,msg)
+        return result
 
     def get_input_items(self):
         return self.input_items
@@ -130,6 +130,7 @@ class EntityDataGenerator(BasePreload):
     """
     
     freq = '5min' 
+    is_cacheable = False #generates random data
     # ids of entities to generate. Change the value of the range() function to change the number of entities
     
     def __init__ (self, dummy_items, output_item = None):
@@ -201,7 +202,7 @@ class FlowRateMonitor(BaseTransformer):
         super().__init__()
         
     def execute(self,df):
-        df = df.copy()
+        df = self.copy_df(df)
         total_input = df[self.input_flows].sum(axis='columns')
         total_output = df[self.output_flows].sum(axis='columns')
         df[self.output] = np.where((total_input-total_output)/ total_input > self.loss_threshold, True, False)
@@ -216,6 +217,7 @@ class GenerateCerealFillerData(BaseDataSource):
     """
     # The merge_method of any data source function governs how the new data retrieved will be combined with the pipeline
     merge_method = 'replace'
+    is_cacheable = False #generates random data
     # Parameters for data generator
     # Number of days worth of data to generate on initial execution
     days = 1
@@ -279,7 +281,7 @@ class InputsAndOutputsOfMultipleTypes(BaseTransformer):
         super().__init__()
         
     def execute(self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         df[self.output_number] = df[self.input_number]
         df[self.output_date] = df[self.input_date]
         df[self.output_str] = df[self.input_str]
@@ -489,6 +491,8 @@ class MultiplyArrayByConstant(BaseTransformer):
     Multiply a list of input columns by a constant to produce a new output column for each input column in the list.
     The names of the new output columns are defined in a list(array) rather than as discrete parameters.
     '''
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self, input_items, constant, output_items):
                 
@@ -498,7 +502,7 @@ class MultiplyArrayByConstant(BaseTransformer):
         super().__init__()
 
     def execute(self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         for i,input_item in enumerate(self.input_items):
             df[self.output_items[i]] = df[input_item] * self.constant
         return df
@@ -508,6 +512,8 @@ class MultiplyByTwo(BaseTransformer):
     '''
     Multiply input column by 2 to produce output column
     '''
+    is_cacheable = True
+    has_side_effects = False
     auto_register_args = {
         'input_item' : 'x_1'
         }
@@ -520,7 +526,7 @@ class MultiplyByTwo(BaseTransformer):
         super().__init__()
 
     def execute(self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         df[self.output_item] = df[self.input_item] * 2
         return df
 
@@ -528,6 +534,9 @@ class MultiplyByConstant(BaseTransformer):
     '''
     Multiply input column by a constant to produce output column
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self, input_item, constant, output_item = 'output_item'):
                 
@@ -538,7 +547,7 @@ class MultiplyByConstant(BaseTransformer):
         super().__init__()
 
     def execute(self, df):
-        df = df.copy()        
+        df = self.copy_df(df)
         df[self.output_item] = df[self.input_item] * self.constant
         return df
     
@@ -546,6 +555,9 @@ class MultiplyByConstantPicklist(BaseTransformer):
     '''
     Multiply input value by a constant that will be entered via a picklist.
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self, input_item, constant, output_item = 'output_item'):
                 
@@ -557,7 +569,7 @@ class MultiplyByConstantPicklist(BaseTransformer):
         self.itemValues['constant'] = [-1,2,3,4,5]
 
     def execute(self, df):
-        df = df.copy()        
+        df = self.copy_df(df)
         df[self.output_item] = df[self.input_item] * self.constant
         return df    
 
@@ -565,6 +577,9 @@ class MultiplyTwoItems(BaseTransformer):
     '''
     Multiply two input items together to produce output column
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self, input_item_1, input_item_2, output_item = 'output_item'):
         self.input_item_1 = input_item_1
@@ -574,7 +589,7 @@ class MultiplyTwoItems(BaseTransformer):
         super().__init__()
 
     def execute(self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         df[self.output_item] = df[self.input_item_1] * df[self.input_item_2]
         return df        
 
@@ -582,6 +597,9 @@ class MultiplyNItems(BaseTransformer):
     '''
     Multiply multiple items together to produce output column
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
     
     def __init__(self, input_items, output_item = 'output_item'):
     
@@ -591,7 +609,7 @@ class MultiplyNItems(BaseTransformer):
         super().__init__()
         
     def execute(self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         df[self.output_item] = df[self.input_items].product(axis=1)
         return df
 
@@ -599,6 +617,9 @@ class NegativeRemover(BaseTransformer):
     '''
     Replace negative values with NaN
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
 
     def __init__(self, names, sources=None):
         if names is None:
@@ -647,7 +668,7 @@ class PivotRowsToColumns(BaseTransformer):
         
     def execute (self,df):
         
-        df = df.copy()
+        df = self.copy_df(df)
         for i,value in enumerate(self.pivot_values):
             if not isinstance(self.input_item, bool):
                 input_item = df[self.input_item]
@@ -670,6 +691,9 @@ class OutlierRemover(BaseTransformer):
     '''
     Replace values outside of a threshold with NaN
     '''
+    is_row_wise = True
+    is_cacheable = True
+    has_side_effects = False
 
     def __init__(self, name, source, min, max):
         if name is None:
@@ -810,6 +834,7 @@ class TimeToFirstAndLastInDay(BaseTransformer):
     the time until the end of period from the last occurance of a measurement
     '''
     execute_by = ['id','_day']
+    requires_index_columns = True
     period_start = '_day'
     period_end = '_day_end'
     
@@ -833,7 +858,7 @@ class TimeToFirstAndLastInDay(BaseTransformer):
     
     def execute(self,df):
         
-        df = df.copy()
+        df = self.copy_df(df)
         df = self._add_period_start_end(df)
         df = super().execute(df)
         df[self.time_to_first] = (df[self.time_to_first]-pd.to_datetime(df[self.period_start])).dt.total_seconds() / 60
@@ -886,6 +911,8 @@ class WriteDataFrame(BaseTransformer):
     out_table_prefix = ''
     version_db_writes = False
     out_table_if_exists = 'append'
+    is_cross_entity = True #writes to the database. Not executed in entity partitions
+    is_cacheable = False
 
     def __init__(self, input_items, out_table_name, output_status= 'output_status'):
         self.input_items = input_items
@@ -894,7 +921,7 @@ class WriteDataFrame(BaseTransformer):
         super().__init__()
         
     def execute (self, df):
-        df = df.copy()
+        df = self.copy_df(df)
         df[self.output_status] = self.write_frame(df=df[self.input_items])
         return df
     
@@ -9,7 +9,16 @@
 # *****************************************************************************
 
 import os
+import re
+import ast
 import tempfile
+import functools
+import inspect
+import json
+import threading
+import queue
+import time
+import tracemalloc
 import dill as pickle
 import requests
 import datetime
@@ -19,8 +28,25 @@ import hashlib
 import hmac
 from lxml import etree
 import logging
+import numpy as np
 import pandas as pd
 logger = logging.getLogger(__name__)
+try:
+    import numexpr
+except (ImportError,ModuleNotFoundError):
+    NUMEXPR_INSTALLED = False
+    msg = 'numexpr is not installed. Expressions will be evaluated using python eval.'
+    logger.info(msg)
+else:
+    NUMEXPR_INSTALLED = True
+try:
+    import pyarrow
+except (ImportError,ModuleNotFoundError):
+    PYARROW_INSTALLED = False
+    msg = 'pyarrow is not installed. Cached stage results will be stored as pickles.'
+    logger.info(msg)
+else:
+    PYARROW_INSTALLED = True
 try:
     import ibm_boto3
     from ibm_boto3.s3.transfer import S3Transfer
@@ -73,6 +99,179 @@ def compare_dataframes(dfl,dfr,cols=None):
         differences = differences + total_rows - len(df.index)
     
     return (differences,trace,df)
+
+
+# time spent in external service calls, accumulated separately by each thread
+_service_times = threading.local()
+
+def get_service_times():
+    '''
+    Get a dict of the seconds spent by the current thread in external service calls keyed by service
+    '''
+    try:
+        return _service_times.totals
+    except AttributeError:
+        _service_times.totals = {}
+        return _service_times.totals
+
+# when set, service calls are recorded or replayed by this ServiceRecorder
+_service_recorder = None
+
+def set_service_recorder(recorder):
+    '''
+    Route service calls through a ServiceRecorder. Set to None to call services directly.
+    '''
+    global _service_recorder
+    _service_recorder = recorder
+
+def timed_service_call(service):
+    '''
+    Decorator that adds the elapsed time of a call to the service totals of the current thread.
+    Only the outermost service call is timed and recorded. Calls that it makes to
+    other decorated services are included in its elapsed time.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args,**kwargs):
+            if getattr(_service_times,'depth',0) > 0:
+                return method(*args,**kwargs)
+            _service_times.depth = 1
+            start = time.perf_counter()
+            try:
+                if _service_recorder is None:
+                    return method(*args,**kwargs)
+                return _service_recorder.call(service,method,args,kwargs)
+            finally:
+                _service_times.depth = 0
+                totals = get_service_times()
+                totals[service] = totals.get(service,0) + time.perf_counter() - start
+        return wrapper
+    return decorator
+
+
+class _RecordedResults(list):
+    '''
+    List of results recorded from a service call that returned an iterator
+    '''
+    pass
+
+
+class ServiceRecorder(object):
+    '''
+    Record the results of service calls made through timed_service_call so that
+    a pipeline can be replayed without access to the database, COS or the AS API.
+    
+    Calls are keyed by method, stage configuration and arguments. When replaying,
+    repeated calls with the same key return the recorded results in the order
+    they were recorded. When the recorded results are exhausted the last one is
+    returned again.
+    '''
+    
+    def __init__(self, calls = None, replay = False, strict = False):
+        if calls is None:
+            calls = {}
+        self.calls = calls
+        self.replay = replay
+        self.strict = strict
+        self.misses = []
+        self._positions = {}
+        self._lock = threading.Lock()
+        
+    def call(self,service,method,args,kwargs):
+        '''
+        Record or replay a call to a service method
+        '''
+        key = self.get_key(method,args,kwargs)
+        if not self.replay:
+            result = method(*args,**kwargs)
+            # iterators, e.g. chunks returned by read_sql, are consumed and recorded as a list
+            # other results are recorded as they are
+            try:
+                is_iterator = iter(result) is result
+            except TypeError:
+                is_iterator = False
+            if is_iterator:
+                result = _RecordedResults(result)
+            if isinstance(result,_RecordedResults):
+                recorded = _RecordedResults([self._copy(x) for x in result])
+            else:
+                recorded = self._copy(result)
+            with self._lock:
+                self.calls.setdefault(key,[]).append(recorded)
+            return self._copy(result)
+        with self._lock:
+            results = self.calls.get(key)
+            if not results:
+                self.misses.append(key)
+                msg = 'No recorded result for %s call %s' %(service,key)
+                if self.strict:
+                    raise KeyError(msg)
+                logger.warning(msg)
+                return None
+            position = self._positions.get(key,0)
+            self._positions[key] = min(position + 1, len(results) - 1)
+            result = results[position]
+        return self._copy(result)
+    
+    def get_key(self,method,args,kwargs):
+        '''
+        Build a key that identifies a service call. Arguments are bound to the
+        signature of the method so that keyword and positional arguments match.
+        Stages are identified by their configuration. Other objects that own
+        the method are ignored.
+        '''
+        try:
+            bound = inspect.signature(method).bind(*args,**kwargs)
+        except (TypeError,ValueError):
+            arguments = [(str(i),x) for i,x in enumerate(args)]
+            arguments.extend(sorted(kwargs.items()))
+        else:
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())
+        owner = ''
+        if arguments and arguments[0][0] == 'self':
+            try:
+                metadata = arguments[0][1]._get_arg_metadata()
+            except (AttributeError,TypeError,KeyError):
+                pass
+            else:
+                owner = '%s%s' %(arguments[0][1].__class__.__name__,
+                                 json.dumps(metadata,sort_keys=True,default=str))
+            arguments = arguments[1:]
+        parts = ['%s=%s' %(k,self._get_key_part(v)) for k,v in arguments]
+        return '%s%s(%s)' %(method.__qualname__,owner,','.join(parts))
+    
+    def _copy(self,result):
+        
+        if isinstance(result,_RecordedResults):
+            return iter([self._copy(x) for x in result])
+        if isinstance(result,(pd.DataFrame,pd.Series)):
+            return result.copy()
+        return result
+            
+    def _get_key_part(self,value):
+        
+        if isinstance(value,pd.DataFrame):
+            return 'DataFrame(%s)' %','.join([str(x) for x in value.columns])
+        if isinstance(value,(list,tuple)):
+            return '[%s]' %','.join([self._get_key_part(x) for x in value])
+        if isinstance(value,dict):
+            return '{%s}' %','.join(sorted(['%s:%s' %(k,self._get_key_part(v)) for k,v in value.items()]))
+        if isinstance(value,(bytes,bytearray)):
+            return 'bytes(%s)' %hashlib.sha1(value).hexdigest()
+        if isinstance(value,(set,frozenset)):
+            return '{%s}' %','.join(sorted([self._get_key_part(x) for x in value]))
+        # sqlalchemy queries are identified by their statement and parameters
+        value = getattr(value,'statement',value)
+        try:
+            compiled = value.compile()
+        except (AttributeError,TypeError):
+            # object addresses differ between recording and replay
+            return re.sub(' at 0x[0-9a-fA-F]+','',repr(value))
+        except Exception:
+            return str(value)
+        else:
+            return '%s%s' %(compiled,sorted(compiled.params.items()))
     
 
 class CosClient:
@@ -101,6 +300,7 @@ class CosClient:
         keySigning = self._hash(keyService, 'aws4_request')
         return keySigning
 
+    @timed_service_call('cos')
     def _cos_api_request(self, http_method, bucket, key, request_parameters=None, payload='', extra_headers=None, binary=False):
         if extra_headers is None:
             extra_headers = {}
@@ -219,11 +419,11 @@ class CosClient:
         root = etree.fromstring(str.encode(result))
         return [elem.text for elem in root.findall('Contents/Key', root.nsmap)]
 
-    def cos_put(self, key, payload, bucket, binary=False):
-        if payload is not None:
-            payload = pickle.dumps(payload)
-        else:
+    def cos_put(self, key, payload, bucket, binary=False, serialize=True):
+        if payload is None:
             payload = ''
+        elif serialize:
+            payload = pickle.dumps(payload)
 
         return self._cos_api_request('PUT', bucket=bucket, key=key, payload=payload, binary=binary)
 
@@ -382,7 +582,7 @@ def resample(df,time_frequency,timestamp,dimensions=None,agg=None, default_aggre
     for d in dimensions:
         group_base.append(pd.Grouper(key = d))
     
-    df = df.groupby(group_base).agg(agg)
+    df = df.groupby(group_base,observed=True).agg(agg)
     df.reset_index(inplace=True)
     
     return df
@@ -494,6 +694,566 @@ class MemoryOptimizer:
 
         return df_new
 
+
+class CompiledExpression(object):
+    '''
+    An expression that is parsed, validated and compiled once. Simple arithmetic,
+    comparison and bitwise expressions on df columns and numeric constants are
+    evaluated with pd.eval using numexpr when it is installed. Expressions that
+    pd.eval could evaluate differently from python, e.g. using and, or, not, %,
+    // or ** and chained comparisons, are evaluated with python eval. Compiled
+    expressions are shared. They hold no state of an evaluation.
+    '''
+    # node types that pd.eval evaluates the same way as python using numexpr
+    _vectorizable_nodes = (ast.Expression, ast.BinOp, ast.Compare,
+                           ast.UnaryOp, ast.Subscript, ast.Name, ast.Load,
+                           ast.Constant,
+                           ast.Add, ast.Sub, ast.Mult, ast.Div,
+                           ast.BitAnd, ast.BitOr, ast.USub, ast.UAdd, ast.Invert,
+                           ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+    # deprecated node types used by older versions of python
+    _vectorizable_nodes += tuple(getattr(ast,x) for x in ['Num','Index'] if hasattr(ast,x))
+
+    def __init__(self,expression):
+        self.expression = expression
+        if '${' in expression:
+            expression = re.sub(r"\$\{(\w+)\}", r"df['\1']", expression)
+        self.source = expression
+        tree = ast.parse(self.source, mode = 'eval')
+        self.items = set()
+        self.constants = set()
+        self._validate(tree)
+        self.code = compile(tree, '<expression>', 'eval')
+        self.is_vectorizable = NUMEXPR_INSTALLED and self._is_vectorizable(tree)
+
+    def _subscript_key(self,node):
+        key = node.slice
+        if hasattr(ast,'Index') and isinstance(key,ast.Index):
+            key = key.value
+        value = getattr(key,'value',getattr(key,'s',None))
+        if isinstance(value,str):
+            return value
+        return None
+
+    def _validate(self,tree):
+        '''
+        Reject access to private attributes. Collect the data items and constants used.
+        '''
+        for node in ast.walk(tree):
+            if isinstance(node,ast.Attribute) and node.attr.startswith('__'):
+                msg = 'Expression %s refers to a private attribute %s' %(self.expression,node.attr)
+                raise SyntaxError(msg)
+            if isinstance(node,ast.Name) and node.id.startswith('__'):
+                msg = 'Expression %s refers to a private name %s' %(self.expression,node.id)
+                raise SyntaxError(msg)
+            if isinstance(node,ast.Subscript) and isinstance(node.value,ast.Name):
+                key = self._subscript_key(node)
+                if key is not None and node.value.id == 'df':
+                    self.items.add(key)
+                elif key is not None and node.value.id == 'c':
+                    self.constants.add(key)
+
+    def _is_vectorizable(self,tree):
+        for node in ast.walk(tree):
+            if not isinstance(node,self._vectorizable_nodes):
+                return False
+            if isinstance(node,ast.Name) and node.id != 'df':
+                return False
+            if isinstance(node,ast.Compare) and len(node.ops) > 1:
+                return False
+            if isinstance(node,ast.Constant) and not isinstance(node.value,(int,float)):
+                return False
+            if isinstance(node,ast.Subscript):
+                if not isinstance(node.value,ast.Name) or self._subscript_key(node) is None:
+                    return False
+        return len(self.items) > 0
+
+    def evaluate(self,df,local_dict=None,global_dict=None):
+        '''
+        Evaluate the expression against a dataframe. Names other than df are
+        resolved from local_dict and global_dict.
+        '''
+        if self.is_vectorizable:
+            try:
+                return pd.eval(self.source, engine = 'numexpr', local_dict = {'df' : df})
+            except Exception as e:
+                # e.g. object columns. Only this evaluation falls back to python eval
+                msg = 'Unable to evaluate expression %s using numexpr. Using python eval. %s' %(self.source,e)
+                logger.debug(msg)
+        names = {}
+        if local_dict is not None:
+            names.update(local_dict)
+        names['df'] = df
+        if global_dict is None:
+            global_dict = {'np' : np, 'pd' : pd}
+        return eval(self.code, global_dict, names)
+
+    def __str__(self):
+
+        return self.source
+
+
+@functools.lru_cache(maxsize = 1024)
+def compile_expression(expression):
+    '''
+    Get the compiled form of an expression string. The most recently used
+    compiled expressions are shared by all stages.
+    '''
+    return CompiledExpression(expression)
+
+
+class StageCache(object):
+    '''
+    Local disk cache of stage output columns. Entries are keyed on the stage
+    class, its argument metadata and a fingerprint of its input data. The least
+    recently used entries are evicted when the cache exceeds max_size bytes.
+    '''
+    def __init__(self, directory = None, max_size = None):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(),'iotfunctions_stage_cache')
+        if max_size is None:
+            max_size = 1024 ** 3
+        self.directory = directory
+        self.max_size = max_size
+        if PYARROW_INSTALLED:
+            self.extension = 'parquet'
+        else:
+            self.extension = 'pickle'
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok = True)
+
+    def get_key(self,stage,df,items,constants = None,scope = None):
+        '''
+        Build a cache key for a stage and the input items of a dataframe. The
+        values of the constants referenced by the stage arguments and the scope
+        of the execution, e.g. its start and end timestamps, are part of the key.
+        Returns None when the stage configuration or data cannot be fingerprinted.
+        '''
+        try:
+            args = stage._get_arg_metadata()
+            config = json.dumps(args, sort_keys = True)
+        except (AttributeError,TypeError,ValueError,KeyError):
+            return None
+        cols = sorted([x for x in items if x in df.columns])
+        key = hashlib.sha1()
+        key.update(('%s.%s' %(stage.__class__.__module__,stage.__class__.__name__)).encode())
+        key.update(config.encode())
+        key.update(json.dumps(cols).encode())
+        if scope is not None:
+            key.update(json.dumps([str(x) for x in scope]).encode())
+        if constants:
+            names = sorted(self._get_constant_names(args,constants))
+            key.update(json.dumps([(x,repr(constants[x])) for x in names]).encode())
+        try:
+            key.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+            for c in cols:
+                key.update(pd.util.hash_pandas_object(df[c], index = False).values.tobytes())
+        except TypeError as e:
+            msg = 'Unable to fingerprint input data of stage %s. %s' %(stage.__class__.__name__,e)
+            logger.debug(msg)
+            return None
+        return key.hexdigest()
+
+    def _get_constant_names(self,value,constants):
+        '''
+        Get the names of constants referenced by an argument value. A string
+        references a constant when it is the name of a constant or when it
+        contains an expression reference like c['name'].
+        '''
+        names = set()
+        if isinstance(value,str):
+            if value in constants:
+                names.add(value)
+            for name in re.findall(r'c\[\s*[\'"]([^\'"]+)[\'"]\s*\]',value):
+                if name in constants:
+                    names.add(name)
+        elif isinstance(value,dict):
+            for v in list(value.values()):
+                names |= self._get_constant_names(v,constants)
+        elif isinstance(value,(list,tuple,set)):
+            for v in value:
+                names |= self._get_constant_names(v,constants)
+        return names
+
+    def _filename(self,key):
+        return os.path.join(self.directory,'%s.%s' %(key,self.extension))
+
+    def load(self,key):
+        '''
+        Return the cached output columns for a key or None
+        '''
+        filename = self._filename(key)
+        try:
+            if self.extension == 'parquet':
+                df = pd.read_parquet(filename)
+            else:
+                df = pd.read_pickle(filename)
+            os.utime(filename)
+        except (OSError,ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return df
+
+    def store(self,key,df):
+        '''
+        Write output columns to the cache and evict least recently used entries
+        '''
+        filename = self._filename(key)
+        df = df.reset_index(drop = True)
+        try:
+            if self.extension == 'parquet':
+                df.to_parquet(filename)
+            else:
+                df.to_pickle(filename)
+        except Exception as e:
+            msg = 'Unable to write stage result to cache. %s' %e
+            logger.debug(msg)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache is within max_size
+        '''
+        with self._lock:
+            entries = []
+            for f in os.listdir(self.directory):
+                path = os.path.join(self.directory,f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,path))
+            total = sum([x[1] for x in entries])
+            for (mtime,size,path) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                msg = 'Evicted stage cache entry %s' %path
+                logger.debug(msg)
+
+
+class StageCapture(object):
+    '''
+    Capture the dataframe at stage boundaries to a local directory. Frames
+    are written as compressed parquet (pickle when pyarrow is missing) by a
+    background writer thread. Use load_stage_capture() to reconstruct the
+    dataframe at a stage boundary. Each capture object writes its files under
+    its own run id so that a directory can be reused across runs.
+    '''
+    manifest = 'capture.json'
+    
+    def __init__(self, directory, compression = None):
+        self.directory = directory
+        if PYARROW_INSTALLED:
+            self.extension = 'parquet'
+            if compression is None:
+                compression = 'snappy'
+        else:
+            self.extension = 'pickle'
+            if compression is None:
+                compression = 'gzip'
+        self.compression = compression
+        self.run_id = '%s_%s' %(datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),os.getpid())
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        os.makedirs(self.directory, exist_ok = True)
+
+    def _start_writer(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target = self._write, name = 'stage_capture_writer', daemon = True)
+            self._writer.start()
+
+    def capture(self,name,df,columns=None,removed=None):
+        '''
+        Queue a frame for writing. Supply a list of columns to capture only the
+        columns changed by a stage. Otherwise the whole frame is captured.
+        '''
+        if columns is None:
+            mode = 'full'
+        else:
+            mode = 'delta'
+            columns = list(columns)
+        # a shallow copy keeps the columns of the frame at this stage boundary
+        # the column selection and write happen on the writer thread
+        frame = df.copy(deep = False)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        entry = {'run' : self.run_id,
+                 'seq' : seq,
+                 'stage' : name,
+                 'mode' : mode,
+                 'file' : '%s_%05d_%s.%s' %(self.run_id,seq,re.sub(r'[^\w\-]','_',name),self.extension),
+                 'removed' : list(removed or [])}
+        self._start_writer()
+        self._queue.put((entry,frame,columns))
+
+    def _write(self):
+        while True:
+            (entry,frame,columns) = self._queue.get()
+            try:
+                if columns is not None:
+                    frame = frame[columns]
+                entry['columns'] = [str(x) for x in frame.columns]
+                entry['rows'] = len(frame.index)
+                filename = os.path.join(self.directory,entry['file'])
+                if self.extension == 'parquet':
+                    frame.to_parquet(filename, compression = self.compression)
+                else:
+                    frame.to_pickle(filename, compression = self.compression)
+                with open(os.path.join(self.directory,self.manifest),'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except Exception as e:
+                msg = 'Unable to capture output of stage %s. %s' %(entry['stage'],e)
+                logger.warning(msg)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        '''
+        Wait for queued frames to be written
+        '''
+        self._queue.join()
+
+
+def load_stage_capture(directory,stage=None,run=None):
+    '''
+    Reconstruct the dataframe captured by StageCapture after a named stage.
+    When no stage is named, the dataframe after the last captured stage is returned.
+    When no run is named, the last run captured to the directory is used.
+    '''
+    with open(os.path.join(directory,StageCapture.manifest),'r') as f:
+        entries = [json.loads(x) for x in f if x.strip() != '']
+    if run is None and len(entries) > 0:
+        run = entries[-1].get('run')
+    entries = [x for x in entries if x.get('run') == run]
+    entries = sorted(entries, key = lambda x: x['seq'])
+    df = None
+    for entry in entries:
+        filename = os.path.join(directory,entry['file'])
+        if filename.endswith('.parquet'):
+            frame = pd.read_parquet(filename)
+        else:
+            frame = pd.read_pickle(filename)
+        if entry['mode'] == 'full' or df is None:
+            df = frame
+        else:
+            for c in frame.columns:
+                df[c] = frame[c]
+            removed = [x for x in entry['removed'] if x in df.columns]
+            if len(removed) > 0:
+                df = df.drop(columns = removed)
+        if stage is not None and entry['stage'] == stage:
+            return df
+    if stage is not None:
+        msg = 'No captured output for stage %s of run %s in %s' %(stage,run,directory)
+        raise KeyError(msg)
+    return df
+
+
+class ColumnSpiller(object):
+    '''
+    Keep the memory used by a dataframe within a budget of bytes by spilling
+    columns to memory mapped files. Spilled columns are restored when a later
+    stage needs them. Only columns with a fixed width numpy dtype are spilled.
+    The size of the dataframe is measured with memory_usage including the
+    contents of object columns. Set deep to False for a faster estimate that
+    under-counts object columns.
+    '''
+    def __init__(self, budget, directory = None, deep = True):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(),'iotfunctions_spill')
+        self.budget = budget
+        self.directory = directory
+        self.deep = deep
+        self.spilled = {}
+        os.makedirs(self.directory, exist_ok = True)
+
+    def get_size(self,df):
+        '''
+        Estimate the memory used by a dataframe in bytes
+        '''
+        return int(df.memory_usage(index = True, deep = self.deep).sum())
+
+    def spill(self,df,candidates):
+        '''
+        Spill columns in the order given by candidates until the dataframe is
+        within budget. The spilled columns are dropped together and the rest
+        of the dataframe is copied so that the memory of the dropped columns is
+        released. Returns a tuple containing the new dataframe and a list of
+        the spilled columns.
+        '''
+        size = self.get_size(df)
+        if size <= self.budget:
+            return (df,[])
+        spilled = []
+        for c in candidates:
+            if size <= self.budget:
+                break
+            if c in self.spilled or not isinstance(df.columns.get_loc(c),int):
+                continue
+            values = df[c].values
+            if (not isinstance(values,np.ndarray) or values.dtype.kind not in 'biufcmM'
+                    or len(values) == 0):
+                continue
+            (fd,filename) = tempfile.mkstemp(prefix = 'spill_', suffix = '.dat', dir = self.directory)
+            os.close(fd)
+            mm = np.memmap(filename, dtype = values.dtype, mode = 'w+', shape = values.shape)
+            mm[:] = values
+            mm.flush()
+            del mm
+            self.spilled[c] = (filename,values.dtype,values.shape,df.index,df.columns.get_loc(c))
+            size = size - values.nbytes
+            spilled.append(c)
+        if len(spilled) > 0:
+            # columns of one dtype share a block. Copying the remaining columns
+            # releases the block once the caller drops the original dataframe
+            df = df.drop(columns = spilled).copy()
+            msg = 'Spilled columns %s. Dataframe size %s bytes' %(spilled,self.get_size(df))
+            logger.debug(msg)
+        return (df,spilled)
+
+    def restore(self,df,items = None):
+        '''
+        Restore spilled columns in place. Restores all spilled columns when items is None.
+        '''
+        if items is None:
+            items = list(self.spilled.keys())
+        restored = []
+        for c in items:
+            try:
+                (filename,dtype,shape,index,position) = self.spilled.pop(c)
+            except KeyError:
+                continue
+            mm = np.memmap(filename, dtype = dtype, mode = 'r', shape = shape)
+            values = np.array(mm)
+            del mm
+            os.remove(filename)
+            if c in df.columns:
+                msg = 'Spilled column %s was replaced while spilled. The spilled values are discarded' %c
+                logger.warning(msg)
+                continue
+            if df.index is not index and not df.index.equals(index):
+                # rows changed since the column was spilled. Align on the index.
+                values = pd.Series(values, index = index)
+            df.insert(min(position,len(df.columns)),c,values)
+            restored.append(c)
+        if len(restored) > 0:
+            msg = 'Restored spilled columns %s' %restored
+            logger.debug(msg)
+        return restored
+
+    def close(self):
+        '''
+        Remove the files of columns that are still spilled
+        '''
+        for (filename,dtype,shape,index,position) in list(self.spilled.values()):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.spilled = {}
+
+
+class StageProfiler(object):
+    '''
+    Collect wall time, cpu time, memory, dataframe shape and external service
+    time for each pipeline stage
+    '''
+    def __init__(self, trace_memory = False):
+        self.data = []
+        self.trace_memory = trace_memory
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self,name,df=None):
+        '''
+        Start profiling a stage. Returns a record to pass to stop()
+        '''
+        record = {'stage' : name,
+                  'start' : datetime.datetime.utcnow().isoformat()}
+        (record['rows_in'],record['columns_in']) = self._shape(df)
+        record['_services'] = dict(get_service_times())
+        if self.trace_memory:
+            try:
+                tracemalloc.reset_peak()
+            except AttributeError:
+                pass
+            record['_memory'] = tracemalloc.get_traced_memory()[0]
+        record['_cpu'] = time.thread_time()
+        record['_wall'] = time.perf_counter()
+        return record
+
+    def stop(self,record,df=None):
+        '''
+        Complete a stage record and add it to the profile
+        '''
+        record['wall_time'] = time.perf_counter() - record.pop('_wall')
+        record['cpu_time'] = time.thread_time() - record.pop('_cpu')
+        if self.trace_memory:
+            (current,peak) = tracemalloc.get_traced_memory()
+            start_memory = record.pop('_memory')
+            record['memory_delta'] = current - start_memory
+            record['memory_peak_delta'] = peak - start_memory
+        before = record.pop('_services')
+        for (service,elapsed) in list(get_service_times().items()):
+            record['%s_time' %service] = elapsed - before.get(service,0)
+        (record['rows_out'],record['columns_out']) = self._shape(df)
+        self.data.append(record)
+        return record
+
+    def _shape(self,df):
+        try:
+            return (len(df.index),len(df.columns))
+        except AttributeError:
+            return (None,None)
+
+    def as_dict(self):
+        '''
+        Return the profile as a dict containing a list of stage records and totals
+        '''
+        totals = {}
+        for record in self.data:
+            for key,value in list(record.items()):
+                if key.endswith('_time'):
+                    totals[key] = totals.get(key,0) + value
+        return {'stages' : self.data, 'totals' : totals}
+
+    def as_json(self):
+
+        return json.dumps(self.as_dict(), default = str)
+
+    def save(self,filename):
+        '''
+        Write the profile to a json file
+        '''
+        with open(filename,'w') as f:
+            f.write(self.as_json())
+        return filename
+
+    def __str__(self):
+
+        out = ''
+        for record in self.data:
+            out = out + '%s: %.3f sec. ' %(record['stage'],record['wall_time'])
+        return out
+
+
 class StageException(Exception):
     EXTENSION_DICT = 'extensionDict'
     STAGENAME = 'stageName'
@@ -0,0 +1,51 @@
+import datetime as dt
+import pandas as pd
+from iotfunctions.base import BaseSCDLookup
+from iotfunctions.benchmark import ReplayDatabase
+from iotfunctions.metadata import EntityType
+
+'''
+Test an scd lookup on encoded entity ids
+----------------------------------------
+
+When the _encode_entity_ids param is set, entity ids are encoded as a
+categorical. The scd table may contain entities that are not in the pipeline
+data. Encoding them adds ids to the dictionary of the entity type after the
+pipeline data was encoded. The lookup must still merge the two dataframes.
+
+This test does not need a database connection.
+'''
+
+entity = EntityType('scd_lookup_test',ReplayDatabase(),
+                    **{'_encode_entity_ids' : True,
+                       '_timestamp' : 'evt_timestamp'})
+
+'''
+Pipeline data for entities A and B. The entity ids are encoded before the
+lookup executes, as they would be by an earlier stage.
+'''
+start = dt.datetime(2019,1,1)
+df = pd.DataFrame({'deviceid' : ['A','B','A','B'],
+                   'evt_timestamp' : [start + dt.timedelta(hours = x) for x in [1,1,2,2]],
+                   'temp' : [20.0,21.0,22.0,23.0]})
+df = entity.encode_df_entity_ids(df)
+dtype_before = df['deviceid'].dtype
+
+'''
+The scd table contains entity C which is not in the pipeline data
+'''
+resource_df = pd.DataFrame({'deviceid' : ['A','B','C'],
+                            'start_date' : [start,start,start],
+                            'end_date' : [start + dt.timedelta(days = 1)] * 3,
+                            'firmware' : ['1.0','1.1','2.0']})
+
+lookup = BaseSCDLookup(table_name = 'scd_lookup_test_scd_firmware', output_item = 'firmware')
+lookup.set_entity_type(entity)
+lookup._prefetched_data = resource_df
+df = lookup.execute(df)
+
+assert entity.get_entity_id_dtype() != dtype_before, 'The scd table did not add an id to the dictionary'
+assert 'C' in entity.get_entity_id_dtype().categories
+result = df.reset_index().sort_values(['deviceid','evt_timestamp'])
+assert list(result['firmware']) == ['1.0','1.0','1.1','1.1'], list(result['firmware'])
+print('scd lookup of encoded entity ids ok')